@@ -1,15 +1,54 @@
 import os
 import sys
-import tempfile
+import functools
+import collections
+import threading
 import cv2 as cv
 import numpy as np
-import requests
-import subprocess
-from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor, Future
 
 from lib.page import Page, NotAnImageException
+from lib.cache import Cache, CachedPage
+from lib.manifest import Manifest
+from lib.downloader import Downloader
+from lib.pdf import Pdf
+from lib.archive import Archive, ArchivePage
+from lib.exporter import PanelExporter
+from lib.pipeline import Pipeline, Stage
 from lib.debug import Debug
 
+# Results cache of a worker process, given once when it starts: its size is then kept up to date across pages,
+# rather than being scanned again for each page parsed with a fresh copy of the cache (see Cache.put)
+_worker_cache = None
+
+
+def _init_worker(cache = None):
+	global _worker_cache
+
+	# one page per worker process at a time: don't let OpenCV spawn its own threads on top of that
+	cv.setNumThreads(1)
+
+	_worker_cache = cache
+
+
+def _parse_page(filename, url, page_options, cache = None, image = None, lightweight = False):
+	try:
+		if cache:
+			page = cache.get_page(filename, url, page_options, image)
+		else:
+			page = Page(filename, url = url, image = image, **page_options)
+	except NotAnImageException:
+		return None
+
+	if lightweight:
+		page.lighten()
+
+	return page
+
+
+def _parse_page_in_worker(filename, url, page_options, image = None, lightweight = False):
+	return _parse_page(filename, url, page_options, _worker_cache, image, lightweight)
+
 
 class Kumiko:
 
@@ -27,104 +66,336 @@ class Kumiko:
 
 		self.panel_expansion = options.get('panel_expansion', True)
 
+		# pyramid mode: detect panels on pages downscaled to at most max_pixels pixels, then snap edges at full size
+		self.options['max_pixels'] = options.get('max_pixels', None)
+		self.options['snap_edges'] = options.get('snap_edges', False)
+
+		# number of processes parsing pages in parallel (0 means one per CPU), debug steps need a single process
+		self.options['jobs'] = options.get('jobs', 1)
+		if self.options['jobs'] == 0:
+			self.options['jobs'] = os.cpu_count() or 1
+		if self.options['debug']:
+			self.options['jobs'] = 1
+
+		# in a single process, parse pages in a pipeline of stages (decode, OpenCV processing, geometry, output),
+		# with this many threads for stages that release the GIL
+		self.options['threads'] = options.get('threads', 1)
+		if self.options['threads'] == 0:
+			self.options['threads'] = os.cpu_count() or 1
+		if self.options['debug']:
+			self.options['threads'] = 1
+		self.options['pipeline_stats'] = options.get('pipeline_stats', False)
+		self.pipeline = None  # last pipeline run, see Pipeline.stats()
+
+		# pdf rasterization: resolution (pdftoppm's default is 150 DPI), and gray pages (enough to detect panels)
+		self.options['pdf_dpi'] = options.get('pdf_dpi', None)
+		self.options['pdf_gray'] = options.get('pdf_gray', False)
+		# pages that are just one embedded image (e.g. scans) can be extracted as is instead of being rasterized
+		self.options['pdf_extract_images'] = options.get('pdf_extract_images', False)
+		# number of poppler processes rasterizing pages in parallel (0 means one per CPU), whatever the jobs option
+		self.options['pdf_workers'] = options.get('pdf_workers', 0)
+		if self.options['pdf_workers'] == 0:
+			self.options['pdf_workers'] = os.cpu_count() or 1
+		# keep page images once done (e.g. for an HTML reader to show them), they're removed on exit otherwise
+		self.options['pdf_keep_pages'] = options.get('pdf_keep_pages', False)
+
+		# drop pages' pixel buffers, image data and intermediary data as soon as they're parsed and consumed
+		# (images are read again from files or archives if needed)
+		self.options['lightweight'] = options.get('lightweight', True)
+
+		# results cache, useless when debugging (processing steps are what we want to see)
+		self.cache = None
+		if options.get('cache_dir') and not self.options['debug']:
+			self.cache = Cache(options['cache_dir'], options.get('cache_max_size'))
+
+		# manifest of parsed files, to skip unchanged files when parsing a directory again (or resume a run)
+		self.manifest = None
+		if options.get('manifest') and not self.options['debug']:
+			self.manifest = Manifest(options['manifest'], self.page_options())
+
 		self.page_list = []
 
 	def parse_url_list(self, urls):
+		self.page_list += self.iter_url_pages(urls)
+
+	# Yield pages in urls order, each page is parsed as soon as it is downloaded
+	def iter_url_pages(self, urls):
 		if self.options['progress']:
-			print(len(urls), 'files to download', file = sys.stderr)
+			print(len(urls), 'files to download and cut panels for', file = sys.stderr)
 
-		self.temp_folder = tempfile.TemporaryDirectory()
+		downloader = Downloader(progress = self.options['progress'])
+		yield from self.iter_sources_pages(downloader.iter_downloads(urls), len(urls))
 
-		i = 0
-		nbdigits = len(str(len(urls)))
-		for url in urls:
-			filename = 'img' + ('0' * nbdigits + str(i))[-nbdigits:]
+	# Yield one page from image data (encoded bytes or decoded numpy array) rather than a file, name is for display
+	def iter_image_data_pages(self, image, name = 'image', url = None):
+		yield from self.iter_sources_pages([(name, url, image)], 1)
 
-			if self.options['progress']:
-				print('\t', url, (' -> ' + filename) if urls else '', file = sys.stderr)
-
-			i += 1
-			parts = urlparse(url)
-			if not parts.netloc or not parts.path:
-				continue
+	def parse_pdf_file(self, pdf_filename):
+		self.page_list += self.iter_pdf_pages(pdf_filename)
 
-			r = requests.get(url, timeout = 5)
-			with open(os.path.join(self.temp_folder.name, filename), 'wb') as f:
-				f.write(r.content)
+	# Yield pages in pdf order, each page is parsed as soon as it is rasterized (pages are rasterized in parallel)
+	def iter_pdf_pages(self, pdf_filename):
+		pdf = Pdf(
+			pdf_filename,
+			dpi = self.options['pdf_dpi'],
+			gray = self.options['pdf_gray'],
+			extract_images = self.options['pdf_extract_images'],
+			max_workers = self.options['pdf_workers'],
+			keep_files = self.options['pdf_keep_pages'],
+		)
+		self.temp_folder = pdf.directory
 
-		self.parse_dir(self.temp_folder.name, urls = urls)
+		print(f"Using pdftoppm to extract page images from pdf to {self.temp_folder}", file = sys.stderr)
+		if self.options['progress']:
+			print(pdf.nb_pages, 'pages to rasterize and cut panels for', file = sys.stderr)
+			if self.options['pdf_extract_images']:
+				print(len(pdf.single_image_pages), 'pages are single images, extracted as is', file = sys.stderr)
 
-	def parse_pdf_file(self, pdf_filename):
-		try:
-			subprocess.run(args = ['pdftoppm', '--help'], check = True, capture_output = True)
-		except FileNotFoundError:
-			print("Please `apt install pdftoppm` if you give PDF --input files to Kumiko", file = sys.stderr)
-			sys.exit(1)
+		# not a generator function itself: the pages folder is known right away, before pages are iterated
+		return self.iter_sources_pages(pdf.iter_pages(), pdf.nb_pages)
 
-		self.temp_folder = tempfile.mkdtemp(prefix = "kumiko-pdf-pages-")
+	def parse_archive(self, archive_filename):
+		self.page_list += self.iter_archive_pages(archive_filename)
 
-		print(f"Using pdftoppm to extract jpeg files from pdf to {self.temp_folder}", file = sys.stderr)
-		subprocess.run(args = ['pdftoppm', '-jpeg', pdf_filename, f"{self.temp_folder}/"], check = True)
+	# Yield pages of a CBZ/ZIP archive or multi-page TIFF file, read one by one in memory, in natural order
+	def iter_archive_pages(self, archive_filename):
+		archive = Archive(archive_filename)
+		if self.options['progress']:
+			print(archive.nb_pages, 'pages to cut panels for', file = sys.stderr)
 
-		self.parse_dir(self.temp_folder)
+		yield from self.iter_sources_pages(archive.iter_pages(), archive.nb_pages)
 
 	def parse_dir(self, directory, urls = None):
+		self.parse_images(Kumiko.list_dir(directory), urls)
+
+	@staticmethod
+	def list_dir(directory):
 		filenames = []
 		for filename in os.scandir(directory):
 			filenames.append(filename.path)
-		self.parse_images(filenames, urls)
+		return filenames
 
 	def parse_images(self, filenames, urls = None):
+		self.page_list += self.iter_pages(filenames, urls)
+
+	# Yield pages one by one, in alphabetical order, as soon as they are parsed: no reference is kept on them
+	def iter_pages(self, filenames, urls = None):
 		if self.options['progress']:
 			print(len(filenames), 'files to cut panels for', file = sys.stderr)
 
-		i = -1
-		for filename in sorted(filenames):
-			i += 1
+		filenames = sorted(filenames)
+		sources = zip(filenames, urls if urls else [None] * len(filenames), [None] * len(filenames))
+
+		yield from self.iter_sources_pages(sources, len(filenames), use_manifest = True)
+
+	# Parse pages from (filename, url, image data or None) sources, that may still be coming in (e.g. downloads)
+	# With use_manifest, sources are files that the manifest (if any) knows of, or records once parsed
+	def iter_sources_pages(self, sources, nb_sources, use_manifest = False):
+		manifest = self.manifest if use_manifest else None
+
+		if self.options['jobs'] > 1 and nb_sources > 1:
+			yield from self.iter_sources_pages_in_pool(sources, nb_sources, manifest)
+			return
+
+		if self.options['threads'] > 1 and nb_sources > 1:
+			yield from self.iter_sources_pages_in_pipeline(sources, manifest)
+			return
+
+		for filename, url, image in sources:
+			page = manifest.get_page(filename, url) if manifest else None
+			if page is not None:
+				if self.options['progress']:
+					print("\t", url or filename, "(unchanged)", file = sys.stderr)
+				yield page
+				continue
+
 			if self.options['progress']:
-				print("\t", urls[i] if urls else filename, file = sys.stderr)
+				print("\t", url or filename, file = sys.stderr)
+
+			page = _parse_page(filename, url, self.page_options(), self.cache, image, self.options['lightweight'])
+			if page is not None:
+				if manifest:
+					manifest.record(filename, page)
+				yield from self.lend_image_data(page, image)
+			elif not filename.endswith(".license"):
+				print(f"\n[ERROR] Not an image, will be ignored: {filename}\n", file = sys.stderr)
+
+	def iter_sources_pages_in_pool(self, sources, nb_sources, manifest = None):
+		nb_done = 0
+		progress_lock = threading.Lock()  # progress is shown from the main thread and executor's thread
+
+		def show_progress(name, future):
+			nonlocal nb_done
+			with progress_lock:
+				nb_done += 1
+				print(f"\t[{nb_done}/{nb_sources}] {name}", file = sys.stderr)
+
+		# record pages as soon as they're done, not when they're given back in order
+		def record_page(filename, future):
+			if future.exception() is None and future.result() is not None:
+				manifest.record(filename, future.result())
+
+		# don't run too far ahead of the consumer, parsed pages would pile up in memory
+		max_pending = self.options['jobs'] * 2
+
+		with ProcessPoolExecutor(
+			max_workers = self.options['jobs'], initializer = _init_worker, initargs = (self.cache, )
+		) as executor:
+			pending = collections.deque()
+			for filename, url, image in sources:
+				page = manifest.get_page(filename, url) if manifest else None
+				if page is not None:
+					future = Future()
+					future.set_result(page)
+					if self.options['progress']:
+						show_progress(f"{url or filename} (unchanged)", future)
+					pending.append((filename, None, future))
+					continue
+
+				future = executor.submit(
+					_parse_page_in_worker, filename, url, self.page_options(), image, self.options['lightweight']
+				)
+				if self.options['progress']:
+					future.add_done_callback(functools.partial(show_progress, url or filename))
+				if manifest:
+					future.add_done_callback(functools.partial(record_page, filename))
+				pending.append((filename, image, future))
+
+				if len(pending) >= max_pending:
+					yield from self.pop_parsed_page(pending)
+
+			while pending:
+				yield from self.pop_parsed_page(pending)
+
+	def iter_sources_pages_in_pipeline(self, sources, manifest = None):
+		page_options = self.page_options()
+		threads = self.options['threads']
+
+		# sources go through stages as jobs (dicts), pages that are known already skip processing stages
+		def decode(source):
+			filename, url, image = source
+			# known: page results come from the 'manifest' or the 'cache'
+			job = {'filename': filename, 'url': url, 'image': image, 'page': None, 'known': None, 'key': None}
+
+			job['page'] = manifest.get_page(filename, url) if manifest else None
+			if job['page'] is not None:
+				job['known'] = 'manifest'
+				return job
+
+			if self.cache:
+				job['key'] = self.cache.key(filename, page_options, image)
+				infos = self.cache.get(job['key']) if job['key'] else None
+				if infos is not None:
+					job['page'] = CachedPage(filename, url, infos, image)
+					job['known'] = 'cache'
+					return job
 
 			try:
-				self.parse_image(filename, url = urls[i] if urls else None)
+				if self.cache and job['key'] is None:
+					raise NotAnImageException(f"File {filename} is not an image")
+				job['page'] = Page(filename, url = url, image = image, parse = False, **page_options)
+				job['page'].decode()
 			except NotAnImageException:
-				if not filename.endswith(".license"):
-					print(f"\n[ERROR] Not an image, will be ignored: {filename}\n", file = sys.stderr)
-
-	def parse_image(self, filename, url = None):
-		self.page_list.append(
-			Page(
-				filename,
-				numbering = "rtl" if self.options['rtl'] else "ltr",
-				url = url,
-				min_panel_size_ratio = self.options['min_panel_size_ratio'],
-				panel_expansion = self.panel_expansion,
-			)
+				job['page'] = None
+
+			return job
+
+		def detect_features(job):
+			if job['page'] is not None and not job['known']:
+				job['page'].detect_features()
+			return job
+
+		def find_panels(job):
+			if job['page'] is not None and not job['known']:
+				job['page'].find_panels()
+			return job
+
+		def output(job):
+			page = job['page']
+			if page is None:
+				return job
+
+			if not job['known'] and job['key']:
+				self.cache.put(job['key'], page.get_infos())
+			if manifest and job['known'] != 'manifest':
+				manifest.record(job['filename'], page)
+			if self.options['lightweight']:
+				page.lighten()
+
+			return job
+
+		self.pipeline = Pipeline(
+			[
+				Stage('decode', decode, threads),
+				Stage('opencv', detect_features, threads),
+				Stage('geometry', find_panels),  # python code, holds the GIL anyway
+				Stage('output', output),
+			]
 		)
 
+		for job in self.pipeline.run(sources):
+			if self.options['progress']:
+				unchanged = " (unchanged)" if job['known'] == 'manifest' else ""
+				print("\t", f"{job['url'] or job['filename']}{unchanged}", file = sys.stderr)
+
+			if job['page'] is not None:
+				yield from self.lend_image_data(job['page'], job['image'])
+			elif not job['filename'].endswith(".license"):
+				print(f"\n[ERROR] Not an image, will be ignored: {job['filename']}\n", file = sys.stderr)
+
+		if self.options['pipeline_stats']:
+			print("Pipeline stages:", file = sys.stderr)
+			self.pipeline.print_stats()
+
+	def pop_parsed_page(self, pending):
+		# pages are given back in submission (alphabetical) order, whatever order they were done in
+		filename, image, future = pending.popleft()
+		page = future.result()
+		if page is not None:
+			yield from self.lend_image_data(page, image)
+		elif not filename.endswith(".license"):
+			print(f"\n[ERROR] Not an image, will be ignored: {filename}\n", file = sys.stderr)
+
+	# Lightweight pages drop image data given directly (e.g. downloads), which can't be read again: it's lent back
+	# to them while they're consumed (e.g. to save their panels), rather than kept or sent back by worker processes
+	def lend_image_data(self, page, image):
+		if not self.options['lightweight'] or image is None or isinstance(image, ArchivePage):
+			yield page
+			return
+
+		page.image = image
+		yield page
+		page.lighten()
+
+	def iter_infos(self, filenames, urls = None):
+		for page in self.iter_pages(filenames, urls):
+			yield page.get_infos()
+
+	def page_options(self):
+		return {
+			'numbering': "rtl" if self.options['rtl'] else "ltr",
+			'min_panel_size_ratio': self.options['min_panel_size_ratio'],
+			'panel_expansion': self.panel_expansion,
+			'max_pixels': self.options['max_pixels'],
+			'snap_edges': self.options['snap_edges'],
+		}
+
+	# image may be given as encoded bytes or decoded numpy array, filename is then just a name for it
+	def parse_image(self, filename, url = None, image = None):
+		if self.cache:
+			page = self.cache.get_page(filename, url, self.page_options(), image)
+		else:
+			page = Page(filename, url = url, image = image, **self.page_options())
+
+		if self.options['lightweight']:
+			page.lighten()
+
+		self.page_list.append(page)
+
 	def get_infos(self):
 		return list(map(lambda p: p.get_infos(), self.page_list))
 
-	def save_panels(self, output_base_path = 'auto', output_format = "jpg"):
-		if output_base_path == 'auto':
-			output_base_path = tempfile.mkdtemp(prefix = "kumiko-out-")
-		elif not os.path.isdir(output_base_path):
-			print(
-				f"\n[ERROR] Given --save-panels directory is not a directory: {output_base_path}\n", file = sys.stderr
-			)
-			sys.exit(1)
-
-		nb_written_panels = 0
-		for page in self.page_list:
-			output_path = os.path.join(output_base_path, os.path.basename(page.filename))
-			os.makedirs(output_path, exist_ok = True)
-
-			for i, panel in enumerate(page.panels):
-				x, y, width, height = panel.to_xywh()
-				output_file = os.path.join(output_path, f"panel_{i}.{output_format}")
-				panel = page.img[y:y + height, x:x + width]
-				if cv.imwrite(output_file, panel):
-					nb_written_panels += 1
-				else:
-					print(f"\n[ERROR] Failed to write panel image to {output_file}\n", file = sys.stderr)
-
-		print(f"Saved {nb_written_panels} panel images to {output_base_path}", file = sys.stderr)
+	def save_panels(self, output_base_path = 'auto', output_format = "jpg", quality = None, max_size = None):
+		exporter = PanelExporter(output_base_path, output_format, quality = quality, max_size = max_size)
+		for _ in exporter.iter_export(self.page_list, release_images = False):
+			pass
@@ -0,0 +1,90 @@
+import os
+import re
+import zipfile
+import cv2 as cv
+
+
+class Archive:
+
+	ZIP_EXTENSIONS = ['.cbz', '.zip']
+	TIFF_EXTENSIONS = ['.tif', '.tiff']
+	IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.jp2'] + TIFF_EXTENSIONS
+
+	@staticmethod
+	def is_archive(filename):
+		ext = os.path.splitext(filename)[1].lower()
+		return ext in Archive.ZIP_EXTENSIONS + Archive.TIFF_EXTENSIONS
+
+	# Sort 'page2' before 'page10'
+	@staticmethod
+	def natural_key(name):
+		return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.is_tiff = os.path.splitext(filename)[1].lower() in Archive.TIFF_EXTENSIONS
+
+		if self.is_tiff:
+			self.nb_pages = cv.imcount(filename)
+		else:
+			with zipfile.ZipFile(filename) as zf:
+				members = filter(Archive.is_page, zf.infolist())
+				self.members = sorted(members, key = lambda m: Archive.natural_key(m.filename))
+			self.nb_pages = len(self.members)
+
+	@staticmethod
+	def is_page(member):
+		if member.is_dir() or member.filename.startswith('__MACOSX/'):
+			return False
+
+		name = os.path.basename(member.filename)
+		return not name.startswith('.') and os.path.splitext(name)[1].lower() in Archive.IMAGE_EXTENSIONS
+
+	# Yield (name, url, image) sources in natural page order, image being a handle to read the page when needed
+	def iter_pages(self):
+		if self.is_tiff:
+			yield from self.iter_tiff_pages()
+			return
+
+		for member in self.members:
+			yield member.filename, None, ArchivePage(self.filename, member = member.filename)
+
+	def iter_tiff_pages(self):
+		if self.nb_pages == 1:
+			yield self.filename, None, None
+			return
+
+		nbdigits = len(str(self.nb_pages))
+		for i in range(self.nb_pages):
+			name = self.filename + '-' + str(i + 1).zfill(nbdigits)
+			yield name, None, ArchivePage(self.filename, index = i)
+
+
+# A page of an archive (ZIP member or multi-page TIFF page index), read from the archive file only when needed:
+# pages keep (and send to worker processes) this small handle rather than image data
+class ArchivePage:
+
+	def __init__(self, filename, member = None, index = None):
+		self.filename = filename
+		self.member = member
+		self.index = index
+		self.data = None
+
+	# Encoded bytes of a ZIP member, or decoded image of a TIFF page (b'' if it can't be read), kept until released
+	def read(self):
+		if self.data is None:
+			if self.member is not None:
+				with zipfile.ZipFile(self.filename) as zf:
+					self.data = zf.read(self.member)
+			else:
+				ok, imgs = cv.imreadmulti(self.filename, start = self.index, count = 1)
+				self.data = imgs[0] if ok and imgs else b''
+		return self.data
+
+	def release(self):
+		self.data = None
+
+	# Member path, safe to use as a relative path on disk (no absolute path, no parent folder), None for TIFF pages
+	def relative_path(self):
+		parts = [part for part in re.split(r'[\\/]', self.member or '') if part not in ['', '.', '..']]
+		return os.path.join(*parts) if parts else None
@@ -0,0 +1,171 @@
+import os
+import json
+import hashlib
+import tempfile
+import cv2 as cv
+import numpy as np
+
+from lib.page import Page, NotAnImageException
+from lib.panel import Panel
+from lib.archive import ArchivePage
+
+
+class Cache:
+
+	DEFAULT_MAX_SIZE = 100 * 1024 * 1024  # in bytes
+
+	def __init__(self, directory, max_size = None):
+		self.directory = directory
+		self.max_size = max_size or Cache.DEFAULT_MAX_SIZE
+		self.size = None  # known lazily, then kept up to date when writing entries
+
+		os.makedirs(self.directory, exist_ok = True)
+
+	@staticmethod
+	def hash_file(filename, h = None):
+		h = h or hashlib.sha256()
+		with open(filename, 'rb') as fh:
+			for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+				h.update(chunk)
+		return h
+
+	# Results depend on the image contents and on options used to process it
+	def key(self, filename, page_options, image = None):
+		h = hashlib.sha256()
+		if isinstance(image, ArchivePage):
+			image = image.read()
+		if isinstance(image, np.ndarray):
+			h.update(str(image.shape).encode())
+			h.update(np.ascontiguousarray(image).data)
+		elif image is not None:
+			h.update(image)
+		else:
+			try:
+				Cache.hash_file(filename, h)
+			except OSError:
+				return None
+
+		h.update(json.dumps(page_options, sort_keys = True).encode())
+		h.update(f"pipeline-v{Page.PIPELINE_VERSION}".encode())
+
+		return h.hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key[:2], key + '.json')
+
+	def get(self, key):
+		path = self.path(key)
+		try:
+			with open(path, encoding = "utf8") as fh:
+				infos = json.load(fh)
+		except (OSError, json.decoder.JSONDecodeError):
+			return None
+
+		# mark entry as recently used, eviction removes least recently used entries first
+		try:
+			os.utime(path)
+		except OSError:
+			pass
+
+		return infos
+
+	def put(self, key, infos):
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+
+		# write then rename, so that concurrent readers (e.g. other --jobs processes) never see partial entries
+		fd, temp_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+		with os.fdopen(fd, 'w', encoding = "utf8") as fh:
+			json.dump(infos, fh)
+		os.replace(temp_path, path)
+
+		if self.size is None:
+			self.evict()
+		else:
+			self.size += os.path.getsize(path)
+			if self.size > self.max_size:
+				self.evict()
+
+	def evict(self):
+		entries = []
+		total_size = 0
+		for subdir in os.scandir(self.directory):
+			if not subdir.is_dir():
+				continue
+			for entry in os.scandir(subdir.path):
+				if entry.name.endswith('.tmp'):
+					continue  # being written by another process
+				try:
+					stat = entry.stat()
+				except OSError:
+					continue  # removed by another process meanwhile
+				entries.append((stat.st_mtime, stat.st_size, entry.path))
+				total_size += stat.st_size
+
+		self.size = total_size
+		if total_size <= self.max_size:
+			return
+
+		for _, size, path in sorted(entries):  # oldest first
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+			self.size -= size
+			if self.size <= self.max_size:
+				break
+
+	def get_page(self, filename, url, page_options, image = None):
+		key = self.key(filename, page_options, image)
+		if key is None:
+			raise NotAnImageException(f"File {filename} is not an image")
+
+		infos = self.get(key)
+		if infos is not None:
+			return CachedPage(filename, url, infos, image)
+
+		page = Page(filename, url = url, image = image, **page_options)
+		self.put(key, page.get_infos())
+
+		return page
+
+
+# Stands for a Page whose results were found in cache: the image isn't decoded unless its pixels are needed
+class CachedPage:
+
+	def __init__(self, filename, url, infos, image = None):
+		self.filename = filename
+		self.url = url
+		self.image = image
+
+		self.infos = infos
+		self.infos['filename'] = Page.page_name(filename, url, image)
+		self.infos['license'] = Page.read_license(filename)
+
+		self.numbering = infos['numbering']
+		self.img_size = infos['size']
+		self.panels = list(map(lambda xywh: Panel(page = self, xywh = xywh), infos['panels']))
+		self.panels_index = None
+
+		self._img = None
+
+	@property
+	def img(self):
+		if self._img is None:
+			image = self.image.read() if isinstance(self.image, ArchivePage) else self.image
+			self._img = cv.imread(self.filename) if image is None else Page.decode_image(image)
+		return self._img
+
+	def release_images(self):
+		self._img = None
+		if isinstance(self.image, ArchivePage):
+			self.image.release()
+
+	def lighten(self):
+		self.release_images()
+		if not isinstance(self.image, ArchivePage):
+			self.image = None
+
+	def get_infos(self):
+		return self.infos
@@ -53,6 +53,33 @@ class Debug:
 			'infos': copy.deepcopy(infos),
 		})
 
+	# Map the steps of a page parsed on a downscaled image to full size, the way Page.upscale_panels() maps panels,
+	# so that all steps of the page compare at the same size
+	@staticmethod
+	def upscale_steps(filename, size, full_size):
+		if not Debug.debug:
+			return
+
+		sx = full_size[0] / size[0]
+		sy = full_size[1] / size[1]
+
+		for step in Debug.steps:
+			infos = step['infos']
+			if infos['filename'] != filename or list(infos['size']) != list(size):
+				continue
+
+			panels = []
+			for x, y, w, h in infos['panels']:
+				r = min(round((x + w) * sx), full_size[0])
+				b = min(round((y + h) * sy), full_size[1])
+				x = min(round(x * sx), full_size[0])
+				y = min(round(y * sy), full_size[1])
+				panels.append([x, y, r - x, b - y])
+
+			infos['size'] = full_size
+			infos['gutters'] = [round(infos['gutters'][0] * sx), round(infos['gutters'][1] * sy)]
+			infos['panels'] = panels
+
 	@staticmethod
 	def show_time(name):
 		if not Debug.debug:
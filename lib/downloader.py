@@ -0,0 +1,89 @@
+import sys
+import collections
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class Downloader:
+
+	MAX_WORKERS = 8  # files downloaded at once
+	MAX_PER_HOST = 4  # files downloaded at once from the same host
+	RETRIES = 3
+	TIMEOUT = 5  # in seconds
+	CHUNK_SIZE = 64 * 1024
+
+	def __init__(self, max_workers = None, max_per_host = None, progress = False):
+		self.max_workers = max_workers or Downloader.MAX_WORKERS
+		self.max_per_host = max_per_host or Downloader.MAX_PER_HOST
+		self.progress = progress
+
+		# one pooled keep-alive session for all downloads, retrying on connection errors and transient HTTP errors
+		retry = Retry(total = Downloader.RETRIES, backoff_factor = 0.5, status_forcelist = [429, 500, 502, 503, 504])
+		adapter = HTTPAdapter(pool_maxsize = self.max_workers, max_retries = retry)
+		self.session = requests.Session()
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+		self.host_semaphores = {}
+		self.host_semaphores_lock = threading.Lock()
+
+	def host_semaphore(self, host):
+		with self.host_semaphores_lock:
+			if host not in self.host_semaphores:
+				self.host_semaphores[host] = threading.Semaphore(self.max_per_host)
+			return self.host_semaphores[host]
+
+	def download(self, url):
+		data = bytearray()
+		with self.host_semaphore(urlparse(url).netloc):
+			with self.session.get(url, timeout = Downloader.TIMEOUT, stream = True) as r:
+				r.raise_for_status()
+				for chunk in r.iter_content(chunk_size = Downloader.CHUNK_SIZE):
+					data += chunk
+
+		return bytes(data)
+
+	# Yield (name, url, data) in urls order, each one as soon as its file is downloaded (in memory)
+	def iter_downloads(self, urls):
+		executor = ThreadPoolExecutor(max_workers = self.max_workers)
+
+		# don't download too far ahead of the consumer, downloaded files would pile up in memory
+		max_pending = self.max_workers * 2
+
+		try:
+			pending = collections.deque()
+			nbdigits = len(str(len(urls)))
+			for i, url in enumerate(urls):
+				name = 'img' + ('0' * nbdigits + str(i))[-nbdigits:]
+
+				parts = urlparse(url)
+				if not parts.netloc or not parts.path:
+					continue
+
+				pending.append((name, url, executor.submit(self.download, url)))
+
+				if len(pending) >= max_pending:
+					yield from self.pop_download(pending)
+
+			while pending:
+				yield from self.pop_download(pending)
+		finally:
+			executor.shutdown(cancel_futures = True)
+			self.session.close()
+
+	def pop_download(self, pending):
+		name, url, future = pending.popleft()
+		try:
+			data = future.result()
+		except requests.RequestException as e:
+			print(f"\n[ERROR] Failed to download, will be ignored: {url} ({e})\n", file = sys.stderr)
+			return
+
+		if self.progress:
+			print('\t', url, '->', name, file = sys.stderr)
+
+		yield name, url, data
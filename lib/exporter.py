@@ -0,0 +1,103 @@
+import os
+import sys
+import tempfile
+import collections
+import cv2 as cv
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.archive import ArchivePage
+
+
+class PanelExporter:
+
+	FORMATS = ['jpg', 'png', 'webp']
+
+	# encoding parameter set by 'quality' for each format (PNG has a compression level instead)
+	QUALITY_PARAMS = {
+		'jpg': cv.IMWRITE_JPEG_QUALITY,  # 0-100
+		'png': cv.IMWRITE_PNG_COMPRESSION,  # 0-9
+		'webp': cv.IMWRITE_WEBP_QUALITY,  # 1-100
+	}
+
+	def __init__(
+		self, output_base_path = 'auto', output_format = 'jpg', quality = None, max_size = None, max_workers = None
+	):
+		if output_base_path == 'auto':
+			output_base_path = tempfile.mkdtemp(prefix = "kumiko-out-")
+		elif not os.path.isdir(output_base_path):
+			print(
+				f"\n[ERROR] Given --save-panels directory is not a directory: {output_base_path}\n", file = sys.stderr
+			)
+			sys.exit(1)
+
+		if output_format not in PanelExporter.FORMATS:
+			raise Exception(f"Fatal error, unknown panel image format: {output_format}")
+
+		self.output_base_path = output_base_path
+		self.output_format = output_format
+		self.params = [PanelExporter.QUALITY_PARAMS[output_format], quality] if quality is not None else []
+		self.max_size = max_size  # panels are downscaled to fit in max_size x max_size pixels
+
+		# cv.imwrite releases the GIL, threads encode panels in parallel
+		self.max_workers = max_workers or os.cpu_count() or 1
+
+		# don't let panels waiting to be written pile up (they keep their page's image alive)
+		self.max_pending = self.max_workers * 4
+
+		self.nb_written_panels = 0
+
+	def write_panel(self, img, output_file):
+		if self.max_size:
+			height, width = img.shape[:2]
+			ratio = self.max_size / max(width, height, 1)
+			if ratio < 1:
+				size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+				img = cv.resize(img, size, interpolation = cv.INTER_AREA)
+
+		if cv.imwrite(output_file, img, self.params):
+			return True
+
+		print(f"\n[ERROR] Failed to write panel image to {output_file}\n", file = sys.stderr)
+		return False
+
+	def pop_written_panel(self, pending):
+		if pending.popleft().result():
+			self.nb_written_panels += 1
+
+	# Pages from archives are saved under their path in the archive (see Page.page_name()), others under their name
+	@staticmethod
+	def page_dirname(page):
+		relative_path = page.image.relative_path() if isinstance(page.image, ArchivePage) else None
+		return relative_path or os.path.basename(page.filename)
+
+	# Save panels of each page as it comes (pages are given back as is), then release the page's image buffers
+	def iter_export(self, pages, release_images = True):
+		with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+			pending = collections.deque()
+			for page in pages:
+				output_path = os.path.join(self.output_base_path, PanelExporter.page_dirname(page))
+				os.makedirs(output_path, exist_ok = True)
+
+				img = page.img
+				if img is None:
+					print(f"\n[ERROR] Page image is gone, panels not saved: {page.filename}\n", file = sys.stderr)
+					yield page
+					continue
+
+				for i, panel in enumerate(page.panels):
+					x, y, width, height = panel.to_xywh()
+					output_file = os.path.join(output_path, f"panel_{i}.{self.output_format}")
+					pending.append(executor.submit(self.write_panel, img[y:y + height, x:x + width], output_file))
+
+				if release_images:
+					page.release_images()
+
+				while len(pending) > self.max_pending:
+					self.pop_written_panel(pending)
+
+				yield page
+
+			while pending:
+				self.pop_written_panel(pending)
+
+		print(f"Saved {self.nb_written_panels} panel images to {self.output_base_path}", file = sys.stderr)
@@ -0,0 +1,105 @@
+import os
+import sys
+import json
+import tempfile
+import threading
+
+from lib.page import Page
+from lib.cache import Cache, CachedPage
+
+
+# Journal of parsed files and their results: files that haven't changed since are not parsed again
+class Manifest:
+
+	def __init__(self, filename, page_options):
+		self.filename = filename
+
+		# results depend on options used to process pages
+		self.options = dict(page_options, pipeline_version = Page.PIPELINE_VERSION)
+
+		self.entries = {}  # by absolute file path
+		self.lock = threading.Lock()  # pages may be recorded from several threads (--jobs)
+
+		self.load()
+
+		self.fh = open(self.filename, 'a', encoding = "utf8")
+
+	def load(self):
+		if not os.path.isfile(self.filename):
+			return
+
+		nb_lines = 0
+		with open(self.filename, encoding = "utf8") as fh:
+			for line in fh:
+				nb_lines += 1
+				try:
+					entry = json.loads(line)
+				except json.decoder.JSONDecodeError:
+					continue  # last line may have been cut short, when previous run was interrupted
+
+				if entry.get('options') == self.options:
+					self.entries[entry['path']] = entry
+				else:
+					self.entries.pop(entry.get('path'), None)
+
+		# rewrite journal without outdated entries
+		if nb_lines != len(self.entries):
+			self.compact()
+
+	def compact(self):
+		fd, temp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(self.filename)), suffix = '.tmp')
+		with os.fdopen(fd, 'w', encoding = "utf8") as fh:
+			for entry in self.entries.values():
+				fh.write(json.dumps(entry) + "\n")
+		os.replace(temp_path, self.filename)
+
+	def get_page(self, filename, url):
+		path = os.path.abspath(filename)
+		entry = self.entries.get(path)
+		if entry is None:
+			return None
+
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+
+		if stat.st_size != entry['size']:
+			return None
+
+		# same size but touched: check contents
+		if stat.st_mtime_ns != entry['mtime']:
+			if Cache.hash_file(path).hexdigest() != entry['hash']:
+				return None
+			self.write(dict(entry, mtime = stat.st_mtime_ns))
+
+		return CachedPage(filename, url, entry['infos'])
+
+	def record(self, filename, page):
+		path = os.path.abspath(filename)
+		try:
+			stat = os.stat(path)
+			file_hash = Cache.hash_file(path).hexdigest()
+		except OSError as e:
+			print(f"\n[ERROR] Could not record {filename} in manifest: {e}\n", file = sys.stderr)
+			return
+
+		self.write(
+			{
+				'path': path,
+				'size': stat.st_size,
+				'mtime': stat.st_mtime_ns,
+				'hash': file_hash,
+				'options': self.options,
+				'infos': page.get_infos(),
+			}
+		)
+
+	def write(self, entry):
+		with self.lock:
+			self.entries[entry['path']] = entry
+			self.fh.write(json.dumps(entry) + "\n")
+			self.fh.flush()  # an interrupted run resumes from the last recorded page
+
+	def close(self):
+		self.fh.close()
@@ -3,11 +3,16 @@ import os
 import json
 import sys
 import time
+import contextlib
+import collections
+import heapq
+import bisect
 import cv2 as cv
 import numpy as np
 
-from lib.panel import Panel
-from lib.segment import Segment
+from lib.panel import Panel, PanelArray, PanelsIndex
+from lib.archive import ArchivePage
+from lib.segment import Segment, SegmentSet
 from lib.debug import Debug
 
 
@@ -19,11 +24,103 @@ class Page:
 
 	DEFAULT_MIN_PANEL_SIZE_RATIO = 1 / 10
 
+	# bump this whenever a change in page processing alters results (invalidates cached results)
+	PIPELINE_VERSION = 1
+
+	GRAY_REDUCTION_FLAGS = {
+		1: cv.IMREAD_GRAYSCALE,
+		2: cv.IMREAD_REDUCED_GRAYSCALE_2,
+		4: cv.IMREAD_REDUCED_GRAYSCALE_4,
+		8: cv.IMREAD_REDUCED_GRAYSCALE_8,
+	}
+
+	# JPEG start-of-frame markers (holding the image size), all but DHT, JPG and DAC
+	JPEG_SOF_MARKERS = [0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]
+
+	# Decode encoded image data (bytes), or take an already decoded image (numpy array), as a BGR image
+	@staticmethod
+	def decode_image(image):
+		if isinstance(image, np.ndarray):
+			if image.ndim == 2:
+				return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+			if image.shape[2] == 4:
+				return cv.cvtColor(image, cv.COLOR_BGRA2BGR)
+			return image
+
+		if len(image) == 0:
+			return None
+
+		return cv.imdecode(np.frombuffer(image, dtype = np.uint8), cv.IMREAD_COLOR)
+
+	# Image [width,height] read from PNG or JPEG headers (file name or encoded bytes), without decoding it
+	@staticmethod
+	def read_image_size(image):
+		if isinstance(image, np.ndarray):
+			return [image.shape[1], image.shape[0]]
+
+		try:
+			if isinstance(image, str):
+				with open(image, 'rb') as fh:
+					data = fh.read(64 * 1024)
+			else:
+				data = bytes(image[:64 * 1024])
+		except OSError:
+			return None
+
+		if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+			return [int.from_bytes(data[16:20], 'big'), int.from_bytes(data[20:24], 'big')]
+
+		if data[:2] == b'\xff\xd8':
+			i = 2
+			while i + 9 < len(data):
+				if data[i] != 0xff:
+					return None
+				marker = data[i + 1]
+				if marker in Page.JPEG_SOF_MARKERS:
+					return [int.from_bytes(data[i + 7:i + 9], 'big'), int.from_bytes(data[i + 5:i + 7], 'big')]
+				i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+
+		return None
+
+	# Biggest decoding reduction (JPEG scaled decoding) that keeps at least max_pixels pixels
+	@staticmethod
+	def gray_reduction(size, max_pixels):
+		if not size or not max_pixels:
+			return 1
+
+		for reduction in [8, 4, 2]:
+			if (size[0] // reduction) * (size[1] // reduction) >= max_pixels:
+				return reduction
+
+		return 1
+
+	@staticmethod
+	def read_license(filename):
+		if not os.path.isfile(filename + '.license'):
+			return None
+
+		with open(filename + '.license', encoding = "utf8") as fh:
+			try:
+				return json.load(fh)
+			except json.decoder.JSONDecodeError:
+				print(f"License file {filename+'.license'} is not a valid JSON file", file = sys.stderr)
+				sys.exit(1)
+
+	# Name of a page in results: its URL, its path in the archive it comes from (archive pages may share a file name
+	# in different folders), or its file name
+	@staticmethod
+	def page_name(filename, url = None, image = None):
+		if url:
+			return url
+		if isinstance(image, ArchivePage) and image.member is not None:
+			return image.member
+		return os.path.basename(filename)
+
 	def get_infos(self):
 		actual_gutters = self.actual_gutters()
 
 		return {
-			'filename': self.url if self.url else os.path.basename(self.filename),
+			'filename': Page.page_name(self.filename, self.url, self.image),
 			'size': self.img_size,
 			'numbering': self.numbering,
 			'gutters': [actual_gutters['x'], actual_gutters['y']],
@@ -39,18 +136,23 @@ class Page:
 		debug = False,
 		url = None,
 		min_panel_size_ratio = None,
-		panel_expansion = True
+		panel_expansion = True,
+		image = None,
+		max_pixels = None,
+		snap_edges = False,
+		parse = True
 	):
 		self.filename = filename
+		# image data may be given directly (bytes or numpy array) or read from an archive (ArchivePage),
+		# filename is then just a name
+		self.image = image
 		self.panels = []
-		self.segments = []
+		self.panels_index = None  # see indexed_panels()
+		self.segments = SegmentSet()
+		self.splits = {}  # see Panel.split()
 
 		self.processing_time = None
-		t1 = time.time_ns()
-
-		self.img = cv.imread(filename)
-		if not isinstance(self.img, np.ndarray) or self.img.size == 0:
-			raise NotAnImageException(f"File {filename} is not an image")
+		self.processing_ns = 0
 
 		self.numbering = numbering or "ltr"
 		if not (numbering in ['ltr', 'rtl']):
@@ -59,31 +161,76 @@ class Page:
 		self.small_panel_ratio = min_panel_size_ratio or Page.DEFAULT_MIN_PANEL_SIZE_RATIO
 		self.panel_expansion = panel_expansion
 		self.url = url
+		self.max_pixels = max_pixels
+		self.snap_edges = snap_edges
+
+		# with parse = False, caller runs processing stages itself (e.g. in a pipeline, see lib/pipeline.py)
+		if parse:
+			self.decode()
+			self.detect_features()
+			self.find_panels()
+
+	# Stage 1: decode the image in shades of gray, at the size panels are detected at
+	def decode(self):
+		t1 = time.time_ns()
 
-		self.img_size = list(self.img.shape[:2])
-		self.img_size.reverse()  # get a [width,height] list
+		# Panels are detected in shades of gray: decode straight to gray (possibly at a reduced size
+		# in pyramid mode), the colour image is only decoded when needed (see img property)
+		self._img = None
+		image = self.image_data
+		full_size = Page.read_image_size(self.filename if image is None else image)
+		reduction = 1 if isinstance(image, np.ndarray) else Page.gray_reduction(full_size, self.max_pixels)
+
+		self.gray = self.load_gray(reduction)
+		if not isinstance(self.gray, np.ndarray) or self.gray.size == 0:
+			raise NotAnImageException(f"File {self.filename} is not an image")
+
+		# headers don't tell about EXIF orientation, decode at full size if the reduced image is not as expected
+		if reduction > 1 and (
+			abs(self.gray.shape[0] - math.ceil(full_size[1] / reduction)) > 1
+			or abs(self.gray.shape[1] - math.ceil(full_size[0] / reduction)) > 1
+		):
+			reduction = 1
+			self.gray = self.load_gray()
+
+		if reduction == 1:
+			full_size = list(self.gray.shape[:2])
+			full_size.reverse()  # get a [width,height] list
+		self.img_size = self.full_size = full_size
 
 		Debug.contour_size = 3
 
 		# get license for this file
-		self.license = None
-		if os.path.isfile(filename + '.license'):
-			with open(filename + '.license', encoding = "utf8") as fh:
-				try:
-					self.license = json.load(fh)
-				except json.decoder.JSONDecodeError:
-					print(f"License file {filename+'.license'} is not a valid JSON file", file = sys.stderr)
-					sys.exit(1)
+		self.license = Page.read_license(self.filename)
 
-		Debug.set_base_img(self.img)
+		if Debug.debug:
+			Debug.set_base_img(self.img)
 
 		Debug.add_step('Initial state', self.get_infos())
 		Debug.add_image('Input image')
 
-		self.gray = cv.cvtColor(self.img, cv.COLOR_BGR2GRAY)
 		Debug.add_image('Shades of gray', img = self.gray)
 		Debug.show_time("Shades of gray")
 
+		# Pyramid mode: detect panels on an image downscaled to at most max_pixels pixels,
+		# gray, sobel, contours and segments are then in the downscaled image's coordinates (see self.scale)
+		self.scale = 1
+		if self.max_pixels and full_size[0] * full_size[1] > self.max_pixels:
+			self.scale = math.sqrt(self.max_pixels / (full_size[0] * full_size[1]))
+			self.img_size = [max(1, round(full_size[0] * self.scale)), max(1, round(full_size[1] * self.scale))]
+			self.gray = cv.resize(self.gray, self.img_size, interpolation = cv.INTER_AREA)
+
+			if Debug.debug:
+				Debug.set_base_img(cv.resize(self.img, self.img_size, interpolation = cv.INTER_AREA))
+			Debug.add_image(f"Downscaled to {self.img_size[0]}x{self.img_size[1]}", img = self.gray)
+			Debug.show_time("Downscaled")
+
+		self.processing_ns += time.time_ns() - t1
+
+	# Stage 2: OpenCV image processing (releases the GIL): sobel filter, contours and segments
+	def detect_features(self):
+		t1 = time.time_ns()
+
 		# https://docs.opencv.org/3.4/d2/d2c/tutorial_sobel_derivatives.html
 		ddepth = cv.CV_16S
 		grad_x = cv.Sobel(self.gray, ddepth, 1, 0, ksize = 3, scale = 1, delta = 0, borderType = cv.BORDER_DEFAULT)
@@ -100,6 +247,13 @@ class Page:
 
 		self.get_contours()
 		self.get_segments()
+
+		self.processing_ns += time.time_ns() - t1
+
+	# Stage 3: panels geometry (pure python)
+	def find_panels(self):
+		t1 = time.time_ns()
+
 		self.get_initial_panels()
 		self.group_small_panels()
 		self.split_panels()
@@ -108,8 +262,9 @@ class Page:
 		self.deoverlap_panels()
 		self.exclude_small_panels()
 
+		self.panels.sort()  # TODO: move this below before panels sort-fix, when panels expansion is smarter
+
 		if self.panel_expansion:
-			self.panels.sort()  # TODO: move this below before panels sort-fix, when panels expansion is smarter
 			self.expand_panels()
 
 		if len(self.panels) == 0:
@@ -119,7 +274,113 @@ class Page:
 
 		self.fix_panels_numbering()
 
-		self.processing_time = int((time.time_ns() - t1) / 10**7) / 100
+		if self.scale != 1:
+			self.upscale_panels(self.full_size, self.load_gray() if self.snap_edges else None)
+
+		self.processing_ns += time.time_ns() - t1
+		self.processing_time = int(self.processing_ns / 10**7) / 100
+
+	# Image data given directly, or read from the archive the page is in
+	@property
+	def image_data(self):
+		return self.image.read() if isinstance(self.image, ArchivePage) else self.image
+
+	def load_image(self):
+		image = self.image_data
+		return cv.imread(self.filename) if image is None else Page.decode_image(image)
+
+	# Gray image, decoded at 1/reduction of its size (1, 2, 4 or 8), which JPEG decoding does much faster
+	def load_gray(self, reduction = 1):
+		flags = Page.GRAY_REDUCTION_FLAGS[reduction]
+		image = self.image_data
+
+		if image is None:
+			return cv.imread(self.filename, flags)
+		if isinstance(image, np.ndarray):
+			return cv.cvtColor(Page.decode_image(image), cv.COLOR_BGR2GRAY)
+		if len(image) == 0:
+			return None
+
+		return cv.imdecode(np.frombuffer(image, dtype = np.uint8), flags)
+
+	# Colour image, decoded again if it has been released
+	@property
+	def img(self):
+		if self._img is None:
+			self._img = self.load_image()
+		return self._img
+
+	@img.setter
+	def img(self, img):
+		self._img = img
+
+	# Drop pixel buffers once they're not needed anymore (e.g. panels have been saved), panels are kept
+	def release_images(self):
+		self._img = self.gray = self.sobel = None
+		if isinstance(self.image, ArchivePage):
+			self.image.release()
+
+	# Keep only results (panels' rectangles) and page information, dropping everything used to compute them
+	def lighten(self):
+		self.release_images()
+		if not isinstance(self.image, ArchivePage):
+			self.image = None  # image data given directly can't be read again, archive pages can
+		self.contours = None
+		self.segments = SegmentSet()
+		for p in self.panels:
+			p.polygon = None
+			p.segments = None
+
+	# Map panels found on the downscaled image back to full size, optionally snapping their edges to actual
+	# full resolution edges nearby
+	def upscale_panels(self, full_size, full_gray = None):
+		# x/r and y/b scale factors, so that page edges map to page edges
+		sx = full_size[0] / self.img_size[0]
+		sy = full_size[1] / self.img_size[1]
+
+		for p in self.panels:
+			p.x = min(round(p.x * sx), full_size[0])
+			p.r = min(round(p.r * sx), full_size[0])
+			p.y = min(round(p.y * sy), full_size[1])
+			p.b = min(round(p.b * sy), full_size[1])
+			if p.polygon is not None:
+				p.polygon = np.round(p.polygon * [sx, sy]).astype(int)
+
+		Debug.upscale_steps(Page.page_name(self.filename, self.url, self.image), self.img_size, full_size)
+		self.img_size = full_size
+
+		if full_gray is not None:
+			band = math.ceil(max(sx, sy)) + 1  # rounding error of a downscaled pixel, and then some
+			for p in self.panels:
+				for d in ['x', 'y', 'r', 'b']:
+					self.snap_panel_edge(full_gray, p, d, band)
+
+		Debug.add_step('Upscale panels', self.get_infos())
+
+	# Move a panel edge to the strongest straight edge in the full resolution image, within band pixels
+	def snap_panel_edge(self, full_gray, panel, d, band):
+		coord = getattr(panel, d)
+		vertical = d in ['x', 'r']
+		start = max(0, coord - band)
+		end = min(self.img_size[0 if vertical else 1], coord + band + 1)
+
+		if vertical:
+			crop = full_gray[panel.y:panel.b, start:end]
+		else:
+			crop = full_gray[start:end, panel.x:panel.r]
+		if crop.shape[0] < 3 or crop.shape[1] < 3:
+			return
+
+		grad = np.abs(cv.Sobel(crop, cv.CV_16S, 1 if vertical else 0, 0 if vertical else 1, ksize = 3))
+
+		# number of strong gradient pixels (same threshold as contours detection) along each candidate line
+		edge_len = crop.shape[0 if vertical else 1]
+		profile = (grad > 200).sum(axis = 0 if vertical else 1)
+		if profile.max() < edge_len / 2:
+			return  # no clear edge around here
+
+		candidates = np.flatnonzero(profile >= profile.max() * 0.9) + start
+		setattr(panel, d, int(candidates[np.argmin(np.abs(candidates - coord))]))
 
 	def get_contours(self):
 		# Black background: values above 100 will be black, the rest white
@@ -132,8 +393,6 @@ class Page:
 		Debug.show_time("Get contours")
 
 	def get_segments(self):
-		self.segments = None
-
 		lsd = cv.createLineSegmentDetector(0)
 		dlines = lsd.detect(self.gray)
 
@@ -141,27 +400,20 @@ class Page:
 
 		min_dist = min(self.img_size) * self.small_panel_ratio
 
-		while self.segments is None or len(self.segments) > 500:
-			self.segments = []
-
-			if dlines is None or dlines[0] is None:
-				break
-
-			for dline in dlines[0]:
-				x0 = int(round(dline[0][0]))
-				y0 = int(round(dline[0][1]))
-				x1 = int(round(dline[0][2]))
-				y1 = int(round(dline[0][3]))
+		segments = SegmentSet()
+		if dlines is not None and dlines[0] is not None:
+			segments = SegmentSet(np.rint(dlines[0][:, 0]))
+			dists = segments.dists()
 
-				a = x0 - x1
-				b = y0 - y1
-				dist = math.sqrt(a**2 + b**2)
-				if dist >= min_dist:
-					self.segments.append(Segment([x0, y0], [x1, y1]))
+			# keep at most 500 segments: raise min_dist by 10% steps until the 501st longest segment is too short
+			if len(dists) > 500:
+				dist_501st = np.partition(dists, len(dists) - 501)[len(dists) - 501]
+				while min_dist <= dist_501st:
+					min_dist *= 1.1
 
-			min_dist *= 1.1
+			segments = segments[dists >= min_dist]
 
-		self.segments = Segment.union_all(self.segments)
+		self.segments = SegmentSet.from_segments(Segment.union_all(list(segments)))
 
 		Debug.draw_segments(self.segments, Debug.colours['green'])
 		Debug.add_image("Segment Detector")
@@ -189,34 +441,43 @@ class Page:
 	# Group small panels that are close together, into bigger ones
 	def group_small_panels(self):
 		small_panels = list(filter(lambda p: p.is_small(), self.panels))
-		groups = {}
-		group_id = 0
-
-		for i, p1 in enumerate(small_panels):
-			for p2 in small_panels[i + 1:]:
-				if p1 == p2:
-					continue
-
-				if not p1.is_close(p2):
-					continue
 
-				if p1 not in groups and p2 not in groups:
-					group_id += 1
-					groups[p1] = group_id
-					groups[p2] = group_id
-				elif p1 in groups and p2 not in groups:
-					groups[p2] = groups[p1]
-				elif p2 in groups and p1 not in groups:
-					groups[p1] = groups[p2]
-				elif groups[p1] != groups[p2]:
-					# group group1 and group2 together
-					for p, id in groups.items():
-						if id == groups[p2]:
-							groups[p] = groups[p1]
+		groups = {}  # panel -> group id
+		group_id = 0
+		group_panels = {}  # group id -> indexes of its panels in groups (insertion order), sorted
+		groups_order = {}  # panel -> index in groups
+		grouped_panels = []  # panels in groups insertion order
+
+		def add_to_group(p, id):
+			groups[p] = id
+			groups_order[p] = len(grouped_panels)
+			group_panels.setdefault(id, []).append(len(grouped_panels))
+			grouped_panels.append(p)
+
+		for p1, p2 in Page.close_panels_pairs(small_panels):
+			if p1 not in groups and p2 not in groups:
+				group_id += 1
+				add_to_group(p1, group_id)
+				add_to_group(p2, group_id)
+			elif p1 in groups and p2 not in groups:
+				add_to_group(p2, groups[p1])
+			elif p2 in groups and p1 not in groups:
+				add_to_group(p1, groups[p2])
+			elif groups[p1] != groups[p2]:
+				# group group1 and group2 together: panels of group2 up to p2 (in groups order) join group1,
+				# as relabelling group2's panels stops matching once p2 itself has been relabelled
+				id1 = groups[p1]
+				id2 = groups[p2]
+				n = bisect.bisect_right(group_panels[id2], groups_order[p2])
+				moved = group_panels[id2][:n]
+				group_panels[id2] = group_panels[id2][n:]
+				group_panels[id1] = sorted(group_panels[id1] + moved)
+				for k in moved:
+					groups[grouped_panels[k]] = id1
 
 		grouped = {}
-		for k, v in groups.items():
-			grouped[v] = grouped.get(v, []) + [k]
+		for p in grouped_panels:
+			grouped.setdefault(groups[p], []).append(p)
 
 		for small_panels in grouped.values():
 			big_hull = cv.convexHull(np.concatenate(list(map(lambda p: p.polygon, small_panels))))
@@ -233,86 +494,186 @@ class Page:
 			Debug.add_image('Group small panels')
 		Debug.add_step('Group small panels', self.get_infos())
 
+	# Pairs of panels that are close to each other (see Panel.is_close), in panels order
+	@staticmethod
+	def close_panels_pairs(panels):
+		if not panels:
+			return []
+
+		# sweep over panels sorted by center x: only panels within the widest closeness distance can be close
+		centers_x = [p.x + p.w() / 2 for p in panels]
+		by_center_x = sorted(range(len(panels)), key = lambda i: centers_x[i])
+		sorted_centers_x = [centers_x[i] for i in by_center_x]
+		max_w = max(p.w() for p in panels)
+
+		pairs = []
+		for i, p1 in enumerate(panels):
+			max_dist = (p1.w() + max_w) * 0.75 + 1
+			start = bisect.bisect_left(sorted_centers_x, centers_x[i] - max_dist)
+			end = bisect.bisect_right(sorted_centers_x, centers_x[i] + max_dist)
+			for j in by_center_x[start:end]:
+				if j > i and not p1 == panels[j] and p1.is_close(panels[j]):
+					pairs.append((i, j))
+
+		return [(panels[i], panels[j]) for i, j in sorted(pairs)]
+
 	# See if panels can be cut into several (two non-consecutive points are close)
+	# Biggest panels are split first, subpanels are queued as they come so each panel is evaluated once
 	def split_panels(self):
-		did_split = True
-		while did_split:
-			did_split = False
-			for p in sorted(self.panels, key = lambda p: p.area(), reverse = True):
-				split = p.split()
-				if split is not None:
-					did_split = True
-					self.panels.remove(p)
-					self.panels += split.subpanels
-
-					Debug.draw_contours(list(map(lambda n: n.polygon, split.subpanels)), Debug.colours['blue'])
-					Debug.draw_line(split.segment.a, split.segment.b, Debug.colours['red'])
-					break
+		self.splits = {}
+
+		queue = [(-p.area(), i, p) for i, p in enumerate(self.panels)]  # ties in self.panels order
+		heapq.heapify(queue)
+		nb_queued = len(queue)
 
-			if did_split:
-				Debug.add_image(
-					'Split contours (blue contours, red split-segment, gray polygon dots, purple nearby dots)'
-				)
+		while queue:
+			_, i, p = heapq.heappop(queue)
+			# panels are told apart by identity, other panels may be equal to p (see Panel.__eq__())
+			index = next((k for k, panel in enumerate(self.panels) if panel is p), None)
+			if index is None:
+				continue
+
+			split = p.split()
+			if split is None:
+				continue
+
+			del self.panels[index]
+			self.panels += split.subpanels
+			for subpanel in split.subpanels:
+				heapq.heappush(queue, (-subpanel.area(), nb_queued, subpanel))
+				nb_queued += 1
+
+			Debug.draw_contours(list(map(lambda n: n.polygon, split.subpanels)), Debug.colours['blue'])
+			Debug.draw_line(split.segment.a, split.segment.b, Debug.colours['red'])
+			Debug.add_image('Split contours (blue contours, red split-segment, gray polygon dots, purple nearby dots)')
 
 		Debug.add_step(f"Panels from split contours ({len(self.segments)} segments)", self.get_infos())
 
 	def exclude_small_panels(self):
-		self.panels = list(filter(lambda p: not p.is_small(), self.panels))
+		small = PanelArray.from_panels(self, self.panels).is_small()
+		self.panels = [p for p, is_small in zip(self.panels, small) if not is_small]
 
 		Debug.add_step('Exclude small panels', self.get_infos())
 
 	# Splitting polygons may result in panels slightly overlapping, de-overlap them
+	# Pairs to de-overlap come from one intersection matrix, kept up to date as panels move
 	def deoverlap_panels(self):
-		for p1 in self.panels:
-			for p2 in self.panels:
-				if p1 == p2:
-					continue
+		panels = PanelArray.from_panels(self, self.panels)
 
-				opanel = p1.overlap_panel(p2)
-				if not opanel:
-					continue
+		# matrix[i, j]: Page.deoverlap(p1s[i], p2s[j]) would move them
+		def to_deoverlap(p1s, p2s):
+			(x, y, r, b), apart = p1s.intersections(p2s)
+			return ~p1s.equals(p2s) & ~apart & (
+				(r - x < b - y) & (p1s.r[:, np.newaxis] == r) | (r - x > b - y) & (p1s.b[:, np.newaxis] == b)
+			)
 
-				if opanel.w() < opanel.h() and p1.r == opanel.r:
-					p1.r = opanel.x
-					p2.x = opanel.r
-					continue
+		matrix = to_deoverlap(panels, panels)
 
-				if opanel.w() > opanel.h() and p1.b == opanel.b:
-					p1.b = opanel.y
-					p2.y = opanel.b
-					continue
+		for i, p1 in enumerate(self.panels):
+			j = 0
+			while True:
+				next_j = np.flatnonzero(matrix[i, j:])
+				if len(next_j) == 0:
+					break
+				j += next_j[0]
+
+				p2 = self.panels[j]
+				Page.deoverlap(p1, p2)
+
+				moved = [i, j]
+				panels.array[moved] = [[p.x, p.y, p.r, p.b] for p in [p1, p2]]
+				moved_panels = PanelArray(self, panels.array[moved])
+				matrix[moved, :] = to_deoverlap(moved_panels, panels)
+				matrix[:, moved] = to_deoverlap(panels, moved_panels)
+
+				j += 1
 
 		Debug.add_step('Deoverlap panels', self.get_infos())
 
+	# Move p1's right (or bottom) edge and p2's left (or top) edge where their overlap starts (or ends)
+	@staticmethod
+	def deoverlap(p1, p2):
+		if p1 == p2:
+			return
+
+		opanel = p1.overlap_panel(p2)
+		if not opanel:
+			return
+
+		if opanel.w() < opanel.h() and p1.r == opanel.r:
+			p1.r = opanel.x
+			p2.x = opanel.r
+			return
+
+		if opanel.w() > opanel.h() and p1.b == opanel.b:
+			p1.b = opanel.y
+			p2.y = opanel.b
+
 	# Merge panels that shouldn't have been split (speech bubble diving into a panel)
+	# Containment comes from one matrix, and is checked again for panels as they grow by merging
 	def merge_panels(self):
+		panels = PanelArray.from_panels(self, self.panels)
+		areas = panels.area()
+		contains = panels.contains()
+
 		panels_to_remove = []
 		for i, p1 in enumerate(self.panels):
-			for j, p2 in enumerate(self.panels[i + 1:]):
-				if p1.contains(p2):
+			p1_contains = contains[i]
+			contain_p1 = contains[:, i]
+
+			j = i + 1
+			while True:
+				next_j = np.flatnonzero(p1_contains[j:] | contain_p1[j:])
+				if len(next_j) == 0:
+					break
+				j += next_j[0]
+
+				p2 = self.panels[j]
+				if p1_contains[j]:
 					panels_to_remove.append(p2)
-					p1 = p1.merge(p2)
-				elif p2.contains(p1):
-					panels_to_remove.append(p1)
-					p2 = p2.merge(p1)
+					p1 = p1.merge(p2, panels)
+
+					# see Panel.contains()
+					overlap_areas = PanelArray.from_panels(self, [p1]).overlap_areas(panels)[0]
+					p1_contains = overlap_areas / areas > 0.50
+					contain_p1 = overlap_areas / p1.area() > 0.50
+				else:
+					panels_to_remove.append(p1)  # no need to merge p2 with p1, the merged panel would be left unused
+
+				j += 1
 
 		for p in set(panels_to_remove):
 			self.panels.remove(p)
 
 		Debug.add_step('Merge panels', self.get_infos())
 
+	# Index panels by their edges for neighbour queries (Panel.find_*_panel) within this context,
+	# panels must not be added or removed meanwhile, moves and reorders go through the index
+	@contextlib.contextmanager
+	def indexed_panels(self):
+		if self.panels_index is not None:  # already indexed by caller
+			yield self.panels_index
+			return
+
+		self.panels_index = PanelsIndex(self.panels)
+		try:
+			yield self.panels_index
+		finally:
+			self.panels_index = None
+
 	# Find out actual gutters between panels
 	def actual_gutters(self, func = min):
 		gutters_x = []
 		gutters_y = []
-		for p in self.panels:
-			left_panel = p.find_left_panel()
-			if left_panel:
-				gutters_x.append(p.x - left_panel.r)
+		with self.indexed_panels():
+			for p in self.panels:
+				left_panel = p.find_left_panel()
+				if left_panel:
+					gutters_x.append(p.x - left_panel.r)
 
-			top_panel = p.find_top_panel()
-			if top_panel:
-				gutters_y.append(p.y - top_panel.b)
+				top_panel = p.find_top_panel()
+				if top_panel:
+					gutters_y.append(p.y - top_panel.b)
 
 		if not gutters_x:
 			gutters_x = [1]
@@ -326,79 +687,201 @@ class Page:
 
 	# Expand panels to their neighbour's edge, or page boundaries
 	def expand_panels(self):
-		gutters = self.actual_gutters()
-		for p in self.panels:
-			for d in ['x', 'y', 'r', 'b']:  # expand in all four directions
-				newcoord = -1
-				neighbour = p.find_neighbour_panel(d)
-				if neighbour:
-					# expand to that neighbour's edge (minus gutter)
-					newcoord = getattr(neighbour, {'x': 'r', 'r': 'x', 'y': 'b', 'b': 'y'}[d]) + gutters[d]
-				else:
-					# expand to the furthest known edge (frame around all panels)
-					min_panel = min(self.panels, key = lambda p: getattr(p, d)) if d in [
-						'x', 'y'
-					] else max(self.panels, key = lambda p: getattr(p, d))
-					newcoord = getattr(min_panel, d)
-
-				if newcoord != -1:
-					if d in ['r', 'b'] and newcoord > getattr(p, d) or d in ['x', 'y'] and newcoord < getattr(p, d):
-						setattr(p, d, newcoord)
-
-		Debug.add_step('Expand panels', self.get_infos())
-
-	# Fix panels simple sorting (issue #12)
+		with self.indexed_panels() as index:
+			gutters = self.actual_gutters()
+			for p in self.panels:
+				for d in ['x', 'y', 'r', 'b']:  # expand in all four directions
+					newcoord = -1
+					neighbour = p.find_neighbour_panel(d)
+					if neighbour:
+						# expand to that neighbour's edge (minus gutter)
+						newcoord = getattr(neighbour, {'x': 'r', 'r': 'x', 'y': 'b', 'b': 'y'}[d]) + gutters[d]
+					else:
+						# expand to the furthest known edge (frame around all panels)
+						coords = index.edges[d][0]
+						newcoord = coords[0] if d in ['x', 'y'] else coords[-1]
+
+					if newcoord != -1:
+						outwards = newcoord > getattr(p, d) if d in ['r', 'b'] else newcoord < getattr(p, d)
+						if outwards:
+							index.update(p, d, newcoord)
+
+			Debug.add_step('Expand panels', self.get_infos())
+
+	# Fix panels simple sorting (issue #12): the first panel that comes before its top neighbour, or before a panel
+	# on its left (ltr) or right (rtl), is moved right after it, until no panel has to move
 	def fix_panels_numbering(self):
-		changes = 1
-		while changes:
-			changes = 0
-			for i, p in enumerate(self.panels):
-				neighbours_before = [p.find_top_panel()]
-				neighbours_before += p.find_all_right_panels() if self.numbering == "rtl" else p.find_all_left_panels()
-
-				for neighbour in neighbours_before:
-					if neighbour is None:
-						continue
-					neighbour_pos = self.panels.index(neighbour)
-					if i < neighbour_pos:
-						changes += 1
-						self.panels.insert(neighbour_pos, self.panels.pop(i))
-						break
-				if changes > 0:
-					break  # start a new whole loop with reordered panels
+		# neighbours are found once: the top neighbour is the first of the closest top panels in current order
+		with self.indexed_panels() as index:
+			tops = {}
+			sides = {}
+			for p in self.panels:
+				top = p.find_top_panel()
+				tops[id(p)] = [] if top is None else [
+					t for t in index.find_all('b', top.b, True, lambda t: t.b == top.b and t.same_col(p))
+				]
+				sides[id(p)] = p.find_all_right_panels() if self.numbering == "rtl" else p.find_all_left_panels()
+
+		if not self.has_numbering_cycle(tops, sides):  # panels would be moved around forever
+			# a neighbour is found at the position of the first panel equal to it (see Panel.__eq__())
+			equal = PanelArray.from_panels(self, self.panels).equals() | np.eye(len(self.panels), dtype = bool)
+			aliases = {id(p): [self.panels[k] for k in np.flatnonzero(equal[:, j])] for j, p in enumerate(self.panels)}
+			positions = {id(p): i for i, p in enumerate(self.panels)}
+
+			def neighbour_position(n):
+				return min(positions[id(a)] for a in aliases[id(n)])
+
+			# panels before a moved panel stay in place, and so do the positions of their neighbours
+			i = 0
+			while i < len(self.panels):
+				p = self.panels[i]
+				neighbours = sorted(tops[id(p)], key = lambda n: positions[id(n)])[:1]
+				neighbours += sorted(sides[id(p)], key = lambda n: positions[id(n)])
+
+				neighbour_pos = next(filter(lambda j: j > i, map(neighbour_position, neighbours)), None)
+				if neighbour_pos is None:
+					i += 1
+					continue
+
+				self.panels.insert(neighbour_pos, self.panels.pop(i))
+				for j in range(i, neighbour_pos + 1):
+					positions[id(self.panels[j])] = j
 
 		Debug.add_step('Numbering fixed', self.get_infos())
 
-	# group big panels together
+	# Whether panels can't all come after their top and side neighbours (tops and sides of panels, by panel id)
+	def has_numbering_cycle(self, tops, sides):
+		before = {id(p): set(map(id, tops[id(p)] + sides[id(p)])) for p in self.panels}
+		after = collections.defaultdict(list)
+		for i, ids in before.items():
+			for j in ids:
+				after[j].append(i)
+
+		nb_before = {i: len(ids) for i, ids in before.items()}
+		ready = [i for i in nb_before if nb_before[i] == 0]
+		nb_ready = len(ready)
+		while ready:
+			for i in after[ready.pop()]:
+				nb_before[i] -= 1
+				if nb_before[i] == 0:
+					ready.append(i)
+					nb_ready += 1
+
+		return nb_ready < len(self.panels)
+
+	# group big panels together: pairs of panels are tried in page order, and the first pair that can be grouped is,
+	# until none can
 	def group_big_panels(self):
-		grouped = True
-		while grouped:
-			grouped = False
-			for i, p1 in enumerate(self.panels):
-				for p2 in self.panels[i + 1:]:
-					p3 = p1.group_with(p2)
-
-					other_panels = [p for p in self.panels if p not in [p1, p2]]
-					if p3.bumps_into(other_panels):
-						continue
-
-					# are there big segments in this panel?
-					segments = []
-					for s in self.segments:
-						if p3.contains_segment(s) and s.dist() > p3.diagonal().dist() / 5:
-							if s not in segments:
-								segments.append(s)
-
-					if len(segments) > 0:  # maybe allow a small number of big segments here?
-						continue
-
-					self.panels.append(p3)
-					self.panels.remove(p1)
-					self.panels.remove(p2)
-					grouped = True
-					break
+		segments_dists = self.segments.dists()
+		has_big_segments = {}  # big segments in a grouped panel only depend on its coordinates
+
+		# panels are known by their rank in page order (grouped panels are added last, and ranked last): pairs of ranks
+		# sort in the order pairs are tried in
+		panels_by_rank = list(self.panels)
+		ranks = {id(p): rank for rank, p in enumerate(panels_by_rank)}
+		on_page = set(ranks.values())
+
+		# a pair whose grouped panel bumps into a panel can't be grouped as long as that panel is there, it is tried
+		# again once that panel is gone (rank of the panel -> pairs)
+		bumped_pairs = collections.defaultdict(list)
+
+		# pairs to try: (rank1, rank2, PAIR, rank of a panel their grouped panel bumped into when queued, or None),
+		# pairs of a panel with the next ones are queued when their turn comes: (rank, next rank, PAIRS, end rank)
+		PAIRS, PAIR = 0, 1
+		queue = [(i, i + 1, PAIRS, len(panels_by_rank)) for i in range(len(panels_by_rank))]
+
+		# page panels, which are equal (see Panel.__eq__(), either way), and their positions in self.panels,
+		# from the last time pairs were queued (None once panels have been grouped)
+		page_index = None
+
+		def index_page():
+			page_panels = PanelArray.from_panels(self, self.panels)
+			equal = page_panels.equals()
+			equal |= equal.T
+			np.fill_diagonal(equal, True)
+			return page_panels, equal, {id(p): k for k, p in enumerate(self.panels)}
+
+		# grouped panels of pairs are checked for bumps all at once, and checked again when tried if they didn't bump
+		# into anything then (panels may have been grouped meanwhile)
+		def queue_pairs(pairs):
+			nonlocal page_index
+
+			pairs = [(i, j) for i, j in pairs if i in on_page and j in on_page]
+			if not pairs:
+				return
+
+			if page_index is None:
+				page_index = index_page()
+			page_panels, equal_panels, positions = page_index
+
+			p1s = PanelArray.from_panels(self, [panels_by_rank[i] for i, _ in pairs])
+			p2s = PanelArray.from_panels(self, [panels_by_rank[j] for _, j in pairs])
+			xy = np.minimum(p1s.array[:, :2], p2s.array[:, :2])
+			rb = np.maximum(p1s.array[:, 2:], p2s.array[:, 2:])
+			p3s = PanelArray(self, np.hstack([xy, rb]))  # see Panel.group_with()
+
+			# overlapping panels, other than panels equal to p1, p2 (either way, to never miss one) or p3
+			bumps = p3s.overlaps(page_panels) & ~page_panels.equals(p3s).T
+			bumps &= ~equal_panels[[positions[id(panels_by_rank[i])] for i, _ in pairs]]
+			bumps &= ~equal_panels[[positions[id(panels_by_rank[j])] for _, j in pairs]]
+
+			for (i, j), bumped, k in zip(pairs, bumps.any(axis = 1), bumps.argmax(axis = 1)):
+				heapq.heappush(queue, (i, j, PAIR, ranks[id(self.panels[k])] if bumped else None))
+
+		panels_xyrb = np.array([[p.x, p.y, p.r, p.b] for p in self.panels])
+		while queue:
+			i, j, kind, value = heapq.heappop(queue)
+			if i not in on_page:
+				continue
+			if kind == PAIRS:
+				queue_pairs([(i, k) for k in range(j, value)])
+				continue
+			if j not in on_page:
+				continue
+			if value in on_page:  # still bumps into that panel
+				bumped_pairs[value].append((i, j))
+				continue
+
+			p1 = panels_by_rank[i]
+			p2 = panels_by_rank[j]
+			p3 = p1.group_with(p2)
 
-				if grouped:
+			# first panel p3 bumps into (overlaps), other than panels equal to p1, p2 or p3
+			bumped_panel = None
+			for k in np.flatnonzero(p3.overlap_mask(panels_xyrb)):
+				p = self.panels[k]
+				if p not in [p1, p2] and not p == p3:
+					bumped_panel = p
 					break
+			if bumped_panel is not None:
+				bumped_pairs[ranks[id(bumped_panel)]].append((i, j))
+				continue
+
+			# are there big segments in this panel?
+			key = (p3.x, p3.y, p3.r, p3.b)
+			if key not in has_big_segments:
+				big_segments = segments_dists > p3.diagonal().dist() / 5
+				has_big_segments[key] = (big_segments & self.segments.overlap_mask(p3)).any()
+			if has_big_segments[key]:  # maybe allow a small number of big segments here?
+				continue
+
+			self.panels.append(p3)
+			ranks[id(p3)] = len(panels_by_rank)
+			panels_by_rank.append(p3)
+			on_page.add(ranks[id(p3)])
+
+			# panels are removed like list.remove() does: the first one equal to p1 (or p2) goes
+			pairs = []
+			for p in [p1, p2]:
+				removed = self.panels.pop(next(k for k, panel in enumerate(self.panels) if panel is p or panel == p))
+				on_page.discard(ranks[id(removed)])
+				pairs += bumped_pairs.pop(ranks[id(removed)], [])
+
+			# only pairs whose grouped panel bumped into a removed panel, and new pairs with p3, can be grouped now
+			page_index = None
+			panels_xyrb = np.array([[p.x, p.y, p.r, p.b] for p in self.panels])
+			queue_pairs(pairs)
+			for p in self.panels[:-1]:
+				heapq.heappush(queue, (ranks[id(p)], ranks[id(p3)], PAIR, None))
 
 		Debug.add_step('Group big panels', self.get_infos())
@@ -1,4 +1,6 @@
 import math
+import copy
+import bisect
 import cv2 as cv
 import numpy as np
 
@@ -8,6 +10,8 @@ from lib.debug import Debug
 
 class Panel:
 
+	__slots__ = ('page', 'x', 'y', 'r', 'b', 'polygon', 'splittable', 'segments', 'coverage')
+
 	@staticmethod
 	def from_xyrb(page, x, y, r, b):
 		return Panel(page, xywh = [x, y, r - x, b - y])
@@ -52,13 +56,11 @@ class Panel:
 		return [self.x, self.y, self.w(), self.h()]
 
 	def __eq__(self, other):
-		return all(
-			[
-				abs(self.x - other.x) < self.wt(),
-				abs(self.y - other.y) < self.ht(),
-				abs(self.r - other.r) < self.wt(),
-				abs(self.b - other.b) < self.ht(),
-			]
+		wt = self.wt()
+		ht = self.ht()
+		return (
+			abs(self.x - other.x) < wt and abs(self.y - other.y) < ht and abs(self.r - other.r) < wt
+			and abs(self.b - other.b) < ht
 		)
 
 	def __lt__(self, other):
@@ -96,14 +98,12 @@ class Panel:
 		return f"{self.x}x{self.y}-{self.r}x{self.b}"
 
 	def __hash__(self):
-		return hash(self.__str__())
+		return hash((self.x, self.y, self.r, self.b))
 
 	def is_small(self, extra_ratio = 1):
-		return any(
-			[
-				self.w() < self.page.img_size[0] * self.page.small_panel_ratio * extra_ratio,
-				self.h() < self.page.img_size[1] * self.page.small_panel_ratio * extra_ratio,
-			]
+		return (
+			self.w() < self.page.img_size[0] * self.page.small_panel_ratio * extra_ratio
+			or self.h() < self.page.img_size[1] * self.page.small_panel_ratio * extra_ratio
 		)
 
 	def is_very_small(self):
@@ -143,6 +143,24 @@ class Panel:
 
 		return opanel.area() / smallest_panel_area > area_ratio
 
+	# Mask of rectangles (N×4 array of x, y, r, b) this panel overlaps, see overlaps()
+	def overlap_mask(self, xyrb):
+		if len(xyrb) == 0:
+			return np.zeros(0, dtype = bool)
+
+		x, y, r, b = np.asarray(xyrb).T
+		apart = (self.x > r) | (x > self.r) | (self.y > b) | (y > self.b)
+
+		overlap_w = np.minimum(self.r, r) - np.maximum(self.x, x)
+		overlap_h = np.minimum(self.b, b) - np.maximum(self.y, y)
+		overlap_area = overlap_w * overlap_h
+		smallest_area = np.minimum(self.area(), (r - x) * (b - y))
+
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			overlaps = (smallest_area == 0) | (overlap_area / smallest_area > 0.1)
+
+		return ~apart & overlaps
+
 	def contains(self, other):
 		o_panel = self.overlap_panel(other)
 		if not o_panel:
@@ -176,28 +194,46 @@ class Panel:
 
 		# intersect
 		intersection_x = min(left.r, right.r) - right.x
-		min_w =  min(left.w(), right.w())
+		min_w = min(left.w(), right.w())
 		return min_w == 0 or intersection_x / min_w >= 1 / 3
 
 	def find_top_panel(self):
+		if self.page.panels_index:
+			return self.page.panels_index.find_top_panel(self)
+
 		all_top = list(filter(lambda p: p.b <= self.y and p.same_col(self), self.page.panels))
 		return max(all_top, key = lambda p: p.b) if all_top else None
 
 	def find_bottom_panel(self):
+		if self.page.panels_index:
+			return self.page.panels_index.find_bottom_panel(self)
+
 		all_bottom = list(filter(lambda p: p.y >= self.b and p.same_col(self), self.page.panels))
 		return min(all_bottom, key = lambda p: p.y) if all_bottom else None
 
 	def find_all_left_panels(self):
+		if self.page.panels_index:
+			return self.page.panels_index.find_all_left_panels(self)
+
 		return list(filter(lambda p: p.r <= self.x and p.same_row(self), self.page.panels))
 
 	def find_left_panel(self):
+		if self.page.panels_index:
+			return self.page.panels_index.find_left_panel(self)
+
 		all_left = self.find_all_left_panels()
 		return max(all_left, key = lambda p: p.r) if all_left else None
 
 	def find_all_right_panels(self):
+		if self.page.panels_index:
+			return self.page.panels_index.find_all_right_panels(self)
+
 		return list(filter(lambda p: p.x >= self.r and p.same_row(self), self.page.panels))
 
 	def find_right_panel(self):
+		if self.page.panels_index:
+			return self.page.panels_index.find_right_panel(self)
+
 		all_right = self.find_all_right_panels()
 		return min(all_right, key = lambda p: p.x) if all_right else None
 
@@ -216,7 +252,8 @@ class Panel:
 		max_b = max(self.b, other.b)
 		return Panel(self.page, [min_x, min_y, max_r - min_x, max_b - min_y])
 
-	def merge(self, other):
+	# page_panels: PanelArray of self.page.panels, if the caller already has one
+	def merge(self, other, page_panels = None):
 		possible_panels = [self]
 
 		# expand self in all four directions where other is
@@ -235,34 +272,31 @@ class Panel:
 			for pp in possible_panels.copy():
 				possible_panels.append(Panel.from_xyrb(self.page, pp.x, pp.y, pp.r, other.b))
 
-		# don't take a merged panel that bumps into other panels on page
-		other_panels = [p for p in self.page.panels if p not in [self, other]]
-		possible_panels = list(filter(lambda p: not p.bumps_into(other_panels), possible_panels))
+		# don't take a merged panel that bumps into (overlaps) other panels on page, all checked at once
+		if page_panels is None:
+			page_panels = PanelArray.from_panels(self.page, self.page.panels)
+		candidates = PanelArray.from_panels(self.page, possible_panels)
 
-		# take the largest merged panel
-		return max(possible_panels, key = lambda p: p.area()) if len(possible_panels) > 0 else self
+		other_panels = ~PanelArray.from_panels(self.page, [self, other]).equals(page_panels).any(axis = 0)
+		other_panels &= np.array([p is not self and p is not other for p in self.page.panels], dtype = bool)
+		bumps = candidates.overlaps(page_panels) & ~page_panels.equals(candidates).T & other_panels
+		bumps = bumps.any(axis = 1)
 
-	def is_close(self, other):
-		c1x = self.x + self.w() / 2
-		c1y = self.y + self.h() / 2
-		c2x = other.x + other.w() / 2
-		c2y = other.y + other.h() / 2
-
-		return all(
-			[
-				abs(c1x - c2x) <= (self.w() + other.w()) * 0.75,
-				abs(c1y - c2y) <= (self.h() + other.h()) * 0.75,
-			]
-		)
+		if bumps.all():
+			return self
 
-	def bumps_into(self, other_panels):
-		for other in other_panels:
-			if other == self:
-				continue
-			if self.overlaps(other):
-				return True
+		# take the largest merged panel, first one on ties
+		return possible_panels[int(np.argmax(np.where(bumps, -1, candidates.area())))]
+
+	def is_close(self, other):
+		w1, h1 = self.w(), self.h()
+		w2, h2 = other.w(), other.h()
+		c1x = self.x + w1 / 2
+		c1y = self.y + h1 / 2
+		c2x = other.x + w2 / 2
+		c2y = other.y + h2 / 2
 
-		return False
+		return abs(c1x - c2x) <= (w1 + w2) * 0.75 and abs(c1y - c2y) <= (h1 + h2) * 0.75
 
 	def contains_segment(self, segment):
 		other = Panel.from_xyrb(None, *segment.to_xyrb())
@@ -272,15 +306,26 @@ class Panel:
 		if self.segments is not None:
 			return self.segments
 
-		self.segments = list(filter(lambda s: self.contains_segment(s), self.page.segments))
+		self.segments = self.page.segments[self.page.segments.overlap_mask(self)]
 
 		return self.segments
 
+	# Split results are memoized by polygon contents in page.splits: a polygon is evaluated once per page
 	def split(self):
 		if self.splittable is False:
 			return None
 
-		split = self._cached_split()
+		if self.polygon is None:
+			split = None
+		else:
+			key = self.polygon.astype(int).tobytes()
+			if key not in self.page.splits:
+				self.page.splits[key] = self._cached_split()
+				split = self.page.splits[key]
+			else:
+				split = self.page.splits[key]
+				if split is not None:
+					split = split.for_panel(self)
 
 		if split is None:
 			self.splittable = False
@@ -304,7 +349,7 @@ class Panel:
 
 		# Compose modified polygon to optimise splits
 		original_polygon = np.copy(self.polygon)
-		polygon = np.ndarray(shape = (0, 1, 2), dtype = int, order = 'F')
+		dots = []
 		intermediary_dots = []
 		extra_dots = []
 
@@ -319,7 +364,7 @@ class Panel:
 				original_polygon[j][0] = seg.center()
 				continue
 
-			polygon = np.append(polygon, [[dot1]], axis = 0)
+			dots.append(dot1)
 
 			# Add dots on *long* edges, by projecting other polygon dots on this segment
 			add_dots = []
@@ -328,22 +373,25 @@ class Panel:
 			if seg.dist() < dots_along_lines_dist * 2:
 				continue
 
-			for k, dot3 in enumerate(original_polygon):
-				if abs(k - i) < min_hops:
-					continue
+			# project all dots at once, same computation as Segment.projected_point()
+			dots3 = original_polygon[:, 0]
+			a = np.array(seg.a)
+			ab = np.array(seg.b) - a
+			ratios = ((dots3 - a) * ab).sum(axis = 1) / np.dot(ab, ab)
+			projected_dots3 = np.rint(a + ratios[:, np.newaxis] * ab).astype(int)
 
-				projected_dot3 = seg.projected_point(dot3)
+			keep = np.abs(np.arange(len(original_polygon)) - i) >= min_hops
 
-				# Segment should be able to contain projected_dot3
-				if not seg.may_contain(projected_dot3):
-					continue
+			# Segment should be able to contain projected_dot3
+			keep &= (projected_dots3[:, 0] >= seg.left()) & (projected_dots3[:, 0] <= seg.right())
+			keep &= (projected_dots3[:, 1] >= seg.top()) & (projected_dots3[:, 1] <= seg.bottom())
 
-				# dot3 should be close to current segment − distance(dot3, projected_dot3) should be short
-				project = Segment(dot3[0], projected_dot3)
-				if project.dist_x() > max_dist_x or project.dist_y() > max_dist_y:
-					continue
+			# dot3 should be close to current segment − distance(dot3, projected_dot3) should be short
+			project_dists = np.abs(projected_dots3 - dots3)
+			keep &= (project_dists[:, 0] <= max_dist_x) & (project_dists[:, 1] <= max_dist_y)
 
-				# append dot3 as intermediary dot on segment(dot1, dot2)
+			# append dots3 as intermediary dots on segment(dot1, dot2)
+			for projected_dot3 in map(tuple, projected_dots3[keep].tolist()):
 				add_dots.append(projected_dot3)
 				intermediary_dots.append(projected_dot3)
 
@@ -363,12 +411,11 @@ class Panel:
 			add_dots.append(dot2b)
 			extra_dots.append(dot2b)
 
-			for dot in sorted(add_dots, key = lambda dot: Segment(dot1, dot).dist()):
-				polygon = np.append(polygon, [[dot]], axis = 0)
+			dots += sorted(add_dots, key = lambda dot: Segment(dot1, dot).dist())
 
 		# Re-merge nearby dots together
-		original_polygon = np.copy(polygon)
-		polygon = np.ndarray(shape = (0, 1, 2), dtype = int, order = 'F')
+		original_polygon = np.array(dots, dtype = int).reshape(-1, 1, 2)
+		dots = []
 
 		for i in range(len(original_polygon)):
 			j = (i + 1) % len(original_polygon)
@@ -383,24 +430,22 @@ class Panel:
 				original_polygon[j][0] = seg.center()
 				continue
 
-			polygon = np.append(polygon, [[dot1]], axis = 0)
+			dots.append(dot1)
+
+		polygon = np.array(dots, dtype = int).reshape(-1, 1, 2)
 
 		Debug.draw_polygon(polygon)
 		Debug.draw_dots(intermediary_dots, Debug.colours['red'])
 		Debug.draw_dots(extra_dots, Debug.colours['yellow'])
 		Debug.add_image(f"Composed polygon {self} ({len(polygon)} dots, {len(intermediary_dots)} intermediary)")
 
-		# Find dots nearby one another
-		nearby_dots = []
-
-		for i in range(len(polygon) - min_hops):
-			for j in range(i + min_hops, len(polygon)):
-				dot1 = polygon[i][0]
-				dot2 = polygon[j][0]
-				seg = Segment(dot1, dot2)
-
-				if seg.dist_x() <= max_dist_x and seg.dist_y() <= max_dist_y:
-					nearby_dots.append([i, j])
+		# Find dots nearby one another: pairs [i, j] with j >= i + min_hops, from pairwise distances
+		dots_x = polygon[:, 0, 0]
+		dots_y = polygon[:, 0, 1]
+		dists_x = np.abs(dots_x[:, np.newaxis] - dots_x)
+		dists_y = np.abs(dots_y[:, np.newaxis] - dots_y)
+		far_enough = np.triu(np.ones((len(polygon), len(polygon)), dtype = bool), k = min_hops)
+		nearby_dots = np.argwhere(far_enough & (dists_x <= max_dist_x) & (dists_y <= max_dist_y)).tolist()
 
 		if len(nearby_dots) == 0:
 			return None
@@ -418,17 +463,8 @@ class Panel:
 				continue
 
 			# Construct two subpolygons by distributing the dots around our nearby dots
-			poly1 = np.zeros(shape = (poly1len, 1, 2), dtype = int)
-			poly2 = np.zeros(shape = (poly2len, 1, 2), dtype = int)
-
-			x = y = 0
-			for i in range(len(polygon)):
-				if i <= dots[0] or i > dots[1]:
-					poly1[x][0] = polygon[i]
-					x += 1
-				else:
-					poly2[y][0] = polygon[i]
-					y += 1
+			poly1 = np.concatenate((polygon[:dots[0] + 1], polygon[dots[1] + 1:]))
+			poly2 = polygon[dots[0] + 1:dots[1] + 1].copy()
 
 			panel1 = Panel(self.page, polygon = poly1)
 			panel2 = Panel(self.page, polygon = poly2)
@@ -461,6 +497,190 @@ class Panel:
 		return best_split
 
 
+# Panels as rows of one N×4 array (x, y, r, b), with vectorized operations giving the same results as Panel
+# methods: pairwise ones return N×M matrices where matrix[i, j] is panels[i].method(others[j]), others being
+# another PanelArray (M panels) or these panels again
+class PanelArray:
+
+	def __init__(self, page, array = None):
+		self.page = page
+		self.array = np.zeros((0, 4), dtype = int) if array is None else np.asarray(array, dtype = int).reshape(-1, 4)
+		self.x, self.y, self.r, self.b = self.array.T
+
+	@staticmethod
+	def from_panels(page, panels):
+		return PanelArray(page, [[p.x, p.y, p.r, p.b] for p in panels])
+
+	def __len__(self):
+		return len(self.array)
+
+	def w(self):
+		return self.r - self.x
+
+	def h(self):
+		return self.b - self.y
+
+	def wt(self):
+		return self.w() / 10
+
+	def ht(self):
+		return self.h() / 10
+
+	def area(self):
+		return self.w() * self.h()
+
+	def is_small(self, extra_ratio = 1):
+		min_w = self.page.img_size[0] * self.page.small_panel_ratio * extra_ratio
+		min_h = self.page.img_size[1] * self.page.small_panel_ratio * extra_ratio
+		return (self.w() < min_w) | (self.h() < min_h)
+
+	# Fuzzy equality, see Panel.__eq__(): not symmetric, thresholds are panels[i]'s
+	def equals(self, others = None):
+		others = self if others is None else others
+		wt = self.wt()[:, np.newaxis]
+		ht = self.ht()[:, np.newaxis]
+		return (
+			(np.abs(self.x[:, np.newaxis] - others.x) < wt) & (np.abs(self.y[:, np.newaxis] - others.y) < ht)
+			& (np.abs(self.r[:, np.newaxis] - others.r) < wt) & (np.abs(self.b[:, np.newaxis] - others.b) < ht)
+		)
+
+	# Overlapping rectangles of all pairs of panels (N×M matrices of x, y, r, b, see Panel.overlap_panel()),
+	# and mask of pairs that don't overlap at all, for which overlap_panel() is None
+	def intersections(self, others = None):
+		others = self if others is None else others
+		x, y, r, b = (c[:, np.newaxis] for c in [self.x, self.y, self.r, self.b])
+
+		apart = (x > others.r) | (others.x > r) | (y > others.b) | (others.y > b)
+		rects = (np.maximum(x, others.x), np.maximum(y, others.y), np.minimum(r, others.r), np.minimum(b, others.b))
+
+		return rects, apart
+
+	def overlap_areas(self, others = None):
+		(x, y, r, b), apart = self.intersections(others)
+		return np.where(apart, 0, (r - x) * (b - y))
+
+	def overlaps(self, others = None):
+		others = self if others is None else others
+		smallest_areas = np.minimum(self.area()[:, np.newaxis], others.area())
+		(x, y, r, b), apart = self.intersections(others)
+
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			return ~apart & ((smallest_areas == 0) | ((r - x) * (b - y) / smallest_areas > 0.1))
+
+	# Empty panels are contained in none (Panel.contains() would divide by zero)
+	def contains(self, others = None):
+		others = self if others is None else others
+
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			return self.overlap_areas(others) / others.area() > 0.50
+
+	def same_row(self, others = None):
+		others = self if others is None else others
+		return PanelArray.same_band(self.y, self.b, others.y, others.b)
+
+	def same_col(self, others = None):
+		others = self if others is None else others
+		return PanelArray.same_band(self.x, self.r, others.x, others.r)
+
+	# Panel.same_row() on top and bottom edges, Panel.same_col() on left and right ones
+	@staticmethod
+	def same_band(start, end, others_start, others_end):
+		start = start[:, np.newaxis]
+		end = end[:, np.newaxis]
+
+		first = start <= others_start  # panels[i] is the first one, as when sorting [panels[i], others[j]]
+		start1 = np.where(first, start, others_start)
+		end1 = np.where(first, end, others_end)
+		start2 = np.where(first, others_start, start)
+		end2 = np.where(first, others_end, end)
+
+		intersection = np.minimum(end1, end2) - start2
+		min_size = np.minimum(end1 - start1, end2 - start2)
+
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			intersect = (min_size == 0) | (intersection / min_size >= 1 / 3)
+
+		return ~(start2 > end1) & ((end2 < end1) | intersect)
+
+
+# Page panels sorted by each of their edges, to find neighbour panels without going through all panels:
+# panels above a panel are those whose bottom edge is above its top edge, etc.
+# Must be kept up to date when panels move (update()) or are reordered (reorder())
+class PanelsIndex:
+
+	def __init__(self, panels):
+		self.panels = panels
+		self.edges = {}  # edge -> [sorted coordinates, panels in the same order]
+		for d in ['x', 'y', 'r', 'b']:
+			sorted_panels = sorted(panels, key = lambda p: getattr(p, d))
+			self.edges[d] = [[getattr(p, d) for p in sorted_panels], sorted_panels]
+
+		self.reorder()
+
+	# panels' positions in page order: neighbour queries give the same results (and ties) as going through panels
+	def reorder(self):
+		self.positions = {id(p): i for i, p in enumerate(self.panels)}
+
+	def update(self, panel, d, coord):
+		coords, sorted_panels = self.edges[d]
+		i = bisect.bisect_left(coords, getattr(panel, d))
+		while sorted_panels[i] is not panel:
+			i += 1
+		del coords[i]
+		del sorted_panels[i]
+
+		setattr(panel, d, coord)
+
+		i = bisect.bisect_left(coords, coord)
+		coords.insert(i, coord)
+		sorted_panels.insert(i, panel)
+
+	# Panels with edge d before (or after) coord, in page order
+	def find_all(self, d, coord, before, match):
+		coords, sorted_panels = self.edges[d]
+		if before:
+			candidates = sorted_panels[:bisect.bisect_right(coords, coord)]
+		else:
+			candidates = sorted_panels[bisect.bisect_left(coords, coord):]
+
+		return sorted(filter(match, candidates), key = lambda p: self.positions[id(p)])
+
+	# Matching panel with the highest (or lowest) edge d before (or after) coord, first one in page order on ties
+	def find_closest(self, d, coord, before, match):
+		coords, sorted_panels = self.edges[d]
+		if before:
+			indexes = range(bisect.bisect_right(coords, coord) - 1, -1, -1)
+		else:
+			indexes = range(bisect.bisect_left(coords, coord), len(coords))
+
+		found = []
+		for i in indexes:
+			if found and coords[i] != getattr(found[0], d):
+				break
+			if match(sorted_panels[i]):
+				found.append(sorted_panels[i])
+
+		return min(found, key = lambda p: self.positions[id(p)]) if found else None
+
+	def find_top_panel(self, panel):
+		return self.find_closest('b', panel.y, True, lambda p: p.same_col(panel))
+
+	def find_bottom_panel(self, panel):
+		return self.find_closest('y', panel.b, False, lambda p: p.same_col(panel))
+
+	def find_all_left_panels(self, panel):
+		return self.find_all('r', panel.x, True, lambda p: p.same_row(panel))
+
+	def find_left_panel(self, panel):
+		return self.find_closest('r', panel.x, True, lambda p: p.same_row(panel))
+
+	def find_all_right_panels(self, panel):
+		return self.find_all('x', panel.r, False, lambda p: p.same_row(panel))
+
+	def find_right_panel(self, panel):
+		return self.find_closest('x', panel.r, False, lambda p: p.same_row(panel))
+
+
 class Split:
 
 	def __init__(self, panel, subpanel1, subpanel2, split_segment):
@@ -468,12 +688,20 @@ class Split:
 		self.subpanels = [subpanel1, subpanel2]
 		self.segment = split_segment
 
-		self.matching_segments = self.segment.intersect_all(self.panel.get_segments())
+		self.matching_segments = self.panel.get_segments().intersect_all(self.segment)
 		self.covered_dist = sum(map(lambda s: s.dist(), self.matching_segments))
 
 	def __eq__(self, other):
 		return self.segment == other.segment
 
+	# Same split of another panel with the same polygon, with its own subpanels
+	def for_panel(self, panel):
+		split = copy.copy(self)
+		split.panel = panel
+		split.subpanels = [Panel(panel.page, polygon = np.copy(p.polygon)) for p in self.subpanels]
+
+		return split
+
 	def segments_coverage(self):
 		segment_dist = self.segment.dist()
 		return self.covered_dist / segment_dist if segment_dist else 0
@@ -0,0 +1,177 @@
+import os
+import re
+import sys
+import math
+import atexit
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Pdf:
+
+	CHUNK_PAGES = 4  # pages rasterized (or extracted) by each poppler process
+
+	# an embedded image is taken as the page image if it covers the page, give or take this ratio
+	FULL_PAGE_TOLERANCE = 3 / 100
+
+	@staticmethod
+	def check_tools(tools):
+		for tool in tools:
+			try:
+				subprocess.run(args = [tool, '-v'], check = True, capture_output = True)
+			except FileNotFoundError:
+				print(
+					f"Please `apt install poppler-utils` ({tool}) if you give PDF --input files to Kumiko",
+					file = sys.stderr
+				)
+				sys.exit(1)
+
+	# Page images are removed when the program exits, unless keep_files (e.g. for an HTML reader to show them)
+	def __init__(
+		self, filename, dpi = None, gray = False, extract_images = False, max_workers = 1, keep_files = False
+	):
+		Pdf.check_tools(['pdftoppm', 'pdfinfo'] + (['pdfimages'] if extract_images else []))
+
+		self.filename = filename
+		self.dpi = dpi
+		self.gray = gray
+		self.max_workers = max(1, max_workers)
+
+		info = subprocess.run(args = ['pdfinfo', filename], check = True, capture_output = True, text = True)
+		self.nb_pages = int(re.search(r'^Pages:\s+(\d+)', info.stdout, re.M)[1])
+		self.nbdigits = len(str(self.nb_pages))
+
+		self.single_image_pages = self.find_single_image_pages() if extract_images else set()
+
+		self.directory = tempfile.mkdtemp(prefix = "kumiko-pdf-pages-")
+		if not keep_files:
+			atexit.register(self.remove_files)
+
+	def remove_files(self):
+		shutil.rmtree(self.directory, ignore_errors = True)
+
+	# Pages that are just one image covering the whole page (typical of scanned comics)
+	def find_single_image_pages(self):
+		info = subprocess.run(
+			args = ['pdfinfo', '-f', '1', '-l', str(self.nb_pages), self.filename],
+			check = True,
+			capture_output = True,
+			text = True
+		)
+		page_sizes = {}
+		for page, w, h in re.findall(r'^Page\s+(\d+) size:\s+([\d.]+) x ([\d.]+) pts', info.stdout, re.M):
+			page_sizes[int(page)] = (float(w), float(h))
+		rotated_pages = set()
+		for page, rot in re.findall(r'^Page\s+(\d+) rot:\s+(\d+)', info.stdout, re.M):
+			if int(rot) % 360 != 0:
+				rotated_pages.add(int(page))
+
+		images = subprocess.run(
+			args = ['pdfimages', '-list', self.filename], check = True, capture_output = True, text = True
+		)
+		page_images = {}
+		for line in images.stdout.splitlines()[2:]:  # skip header lines
+			cols = line.split()
+			if len(cols) < 14:
+				continue
+			page_images.setdefault(int(cols[0]), []).append(cols)
+
+		pages = set()
+		for page, images in page_images.items():
+			if len(images) != 1 or page in rotated_pages or page not in page_sizes:
+				continue  # several images (or masks, stencils...), or image needs a transformation
+
+			_, _, img_type, width, height, color, _, _, _, _, _, _, x_ppi, y_ppi = images[0][:14]
+			if img_type != 'image' or color not in ['gray', 'rgb', 'index']:
+				continue
+			try:
+				# size of the image as displayed on page, in pts
+				display_w = int(width) / int(x_ppi) * 72
+				display_h = int(height) / int(y_ppi) * 72
+			except (ValueError, ZeroDivisionError):
+				continue
+
+			page_w, page_h = page_sizes[page]
+			if abs(display_w - page_w) > page_w * Pdf.FULL_PAGE_TOLERANCE:
+				continue
+			if abs(display_h - page_h) > page_h * Pdf.FULL_PAGE_TOLERANCE:
+				continue
+
+			pages.add(page)
+
+		return pages
+
+	# Run a poppler tool on pages first_page to last_page, in a directory of their own,
+	# then move resulting files to the pages directory, named after their page number
+	def run_on_pages(self, args, first_page, last_page):
+		chunk_dir = tempfile.mkdtemp(dir = self.directory, prefix = '.chunk-')
+
+		args = [args[0], '-f', str(first_page), '-l', str(last_page)] + args[1:]
+		subprocess.run(args = args + [self.filename, os.path.join(chunk_dir, 'page')], check = True)
+
+		filenames = []
+		for page, name in enumerate(sorted(os.listdir(chunk_dir)), start = first_page):
+			ext = os.path.splitext(name)[1]
+			filename = os.path.join(self.directory, 'page-' + str(page).zfill(self.nbdigits) + ext)
+			os.replace(os.path.join(chunk_dir, name), filename)
+			filenames.append(filename)
+		os.rmdir(chunk_dir)
+
+		return filenames
+
+	def rasterize(self, first_page, last_page):
+		# lossless, and can be shown by browsers (see --html)
+		args = ['pdftoppm', '-png']
+		if self.dpi:
+			args += ['-r', str(self.dpi)]
+		if self.gray:
+			args.append('-gray')
+
+		return self.run_on_pages(args, first_page, last_page)
+
+	def extract_images(self, first_page, last_page):
+		# JPEG images are written as is, other ones as PNG
+		filenames = self.run_on_pages(['pdfimages', '-j', '-png'], first_page, last_page)
+		if len(filenames) == last_page - first_page + 1:
+			return filenames
+
+		# not one image per page after all, rasterize them instead
+		for filename in filenames:
+			os.remove(filename)
+		return self.rasterize(first_page, last_page)
+
+	# Consecutive pages handled the same way (rasterized or extracted), by chunks of CHUNK_PAGES pages at most
+	def chunks(self):
+		chunk_pages = max(1, min(Pdf.CHUNK_PAGES, math.ceil(self.nb_pages / self.max_workers)))
+
+		chunk = None
+		for page in range(1, self.nb_pages + 1):
+			extract = page in self.single_image_pages
+			if chunk and chunk[0] == extract and page - chunk[1] < chunk_pages:
+				chunk[2] = page
+			else:
+				if chunk:
+					yield chunk
+				chunk = [extract, page, page]
+
+		if chunk:
+			yield chunk
+
+	# Yield (filename, url, image) sources in pages order, as soon as each chunk of pages is ready
+	def iter_pages(self):
+		with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+			chunks = []
+			for extract, first_page, last_page in self.chunks():
+				chunks.append(
+					executor.submit(self.extract_images if extract else self.rasterize, first_page, last_page)
+				)
+
+			try:
+				for chunk in chunks:
+					for filename in chunk.result():
+						yield filename, None, None
+			finally:
+				for chunk in chunks:
+					chunk.cancel()
@@ -0,0 +1,170 @@
+import sys
+import time
+import queue
+import threading
+
+
+# Items going through stages are wrapped with their position in input order
+class _Item:
+
+	def __init__(self, index, value):
+		self.index = index
+		self.value = value
+		self.error = None  # exception raised by a stage, later stages are skipped and it is raised to the consumer
+
+
+class Stage:
+
+	def __init__(self, name, function, threads = 1):
+		self.name = name
+		self.function = function
+		self.threads = max(1, threads)
+
+		self.nb_items = 0
+		self.busy_ns = 0  # summed over threads
+		self.queue_depth_sum = 0
+		self.queue_depth_max = 0
+
+		self.lock = threading.Lock()
+		self.nb_running_threads = 0
+
+	def add_sample(self, queue_depth, busy_ns):
+		with self.lock:
+			self.nb_items += 1
+			self.busy_ns += busy_ns
+			self.queue_depth_sum += queue_depth
+			self.queue_depth_max = max(self.queue_depth_max, queue_depth)
+
+
+# Run items through stages, each stage in its own threads, stages connected by bounded queues
+# Threads only help where stage functions release the GIL (OpenCV calls, I/O): other stages still run
+# one at a time, but they overlap with those
+class Pipeline:
+
+	def __init__(self, stages, max_pending = None):
+		self.stages = stages
+
+		# items between input and output at any time: caps memory whatever stage is the bottleneck
+		self.max_pending = max_pending or 2 * sum(stage.threads for stage in stages)
+
+		self.start_time = None
+		self.end_time = None
+
+	# Yield stage functions' results in input order, items are read from the iterable in a separate thread
+	def run(self, items):
+		self.start_time = time.time()
+		self.end_time = None
+
+		pending = threading.Semaphore(self.max_pending)
+		stopped = threading.Event()
+
+		# room for all pending items, and end of input markers
+		queue_size = self.max_pending + max(stage.threads for stage in self.stages)
+		queues = [queue.Queue(maxsize = queue_size) for _ in range(len(self.stages) + 1)]
+
+		feed_error = None
+
+		def feed():
+			nonlocal feed_error
+			try:
+				for index, value in enumerate(items):
+					while not pending.acquire(timeout = 0.1):
+						if stopped.is_set():
+							return
+					if stopped.is_set():
+						return
+					queues[0].put(_Item(index, value))
+			except Exception as e:
+				feed_error = e  # reported to the consumer after items read so far
+			finally:
+				for _ in range(self.stages[0].threads):
+					queues[0].put(None)
+
+		def work(i, stage):
+			while True:
+				item = queues[i].get()
+				if item is None:
+					break
+
+				t1 = time.time_ns()
+				if item.error is None and not stopped.is_set():
+					try:
+						item.value = stage.function(item.value)
+					except Exception as e:
+						item.error = e
+				stage.add_sample(queues[i].qsize(), time.time_ns() - t1)
+
+				queues[i + 1].put(item)
+
+			# last thread of this stage done: next stage's threads can stop too
+			with stage.lock:
+				stage.nb_running_threads -= 1
+				last = stage.nb_running_threads == 0
+			if last:
+				next_threads = self.stages[i + 1].threads if i + 1 < len(self.stages) else 1
+				for _ in range(next_threads):
+					queues[i + 1].put(None)
+
+		threads = [threading.Thread(target = feed, daemon = True)]
+		for i, stage in enumerate(self.stages):
+			stage.nb_running_threads = stage.threads
+			threads += [
+				threading.Thread(target = work, args = (i, stage), daemon = True) for _ in range(stage.threads)
+			]
+		for thread in threads:
+			thread.start()
+
+		try:
+			done = {}
+			next_index = 0
+			finished = False
+			while not finished or next_index in done:
+				if next_index in done:
+					item = done.pop(next_index)
+					next_index += 1
+					pending.release()
+					if item.error is not None:
+						raise item.error
+					yield item.value
+					continue
+
+				item = queues[-1].get()
+				if item is None:
+					finished = True
+				else:
+					done[item.index] = item
+
+			if feed_error is not None:
+				raise feed_error
+		finally:
+			stopped.set()
+			self.end_time = time.time()
+
+	def stats(self):
+		elapsed = ((self.end_time or time.time()) - self.start_time) if self.start_time else 0
+
+		stats = []
+		for stage in self.stages:
+			busy_time = stage.busy_ns / 10**9
+			stats.append(
+				{
+					'stage': stage.name,
+					'threads': stage.threads,
+					'items': stage.nb_items,
+					'throughput': stage.nb_items / elapsed if elapsed else 0,  # items per second
+					'busy': busy_time / (elapsed * stage.threads) if elapsed else 0,  # ratio of thread time
+					'queue_depth_avg': stage.queue_depth_sum / stage.nb_items if stage.nb_items else 0,
+					'queue_depth_max': stage.queue_depth_max,
+				}
+			)
+
+		return stats
+
+	def print_stats(self, file = sys.stderr):
+		for s in self.stats():
+			print(
+				f"\t{s['stage']}: {s['items']} items, {s['throughput']:.1f}/s, "
+				f"{s['threads']} thread(s) {s['busy']:.0%} busy, "
+				f"queue depth {s['queue_depth_avg']:.1f} avg, {s['queue_depth_max']} max",
+				file = file
+			)
@@ -126,13 +126,10 @@ class Segment:
 		return math.atan(self.dist_y() / self.dist_x()) if self.dist_x() != 0 else math.pi / 2
 
 	def intersect_all(self, segments):
-		segments_match = []
-		for segment in segments:
-			s3 = self.intersect(segment)
-			if s3 is not None:
-				segments_match.append(s3)
+		if not isinstance(segments, SegmentSet):
+			segments = SegmentSet.from_segments(segments)
 
-		return Segment.union_all(segments_match)
+		return segments.intersect_all(self)
 
 	@staticmethod
 	def along_polygon(polygon, i, j):
@@ -158,27 +155,34 @@ class Segment:
 
 		return split_segment
 
+	# Segments equal to each other (whatever their direction) have the same key
+	def key(self):
+		return (self.a, self.b) if self.a <= self.b else (self.b, self.a)
+
 	@staticmethod
 	def union_all(segments):
 		unioned_segments = True
 		while unioned_segments:
 			unioned_segments = False
 			dedup_segments = []
-			used = []
+			used = set()
+			index = SegmentIndex(segments)
 			for i, s1 in enumerate(segments):
-				for s2 in segments[i + 1:]:
-					if s2 in used:
+				# only segments that may be unioned with s1, in segments order
+				for j in index.candidates(i):
+					s2 = segments[j]
+					if s2.key() in used:
 						continue
 
 					s3 = s1.union(s2)
 					if s3 is not None:
 						unioned_segments = True
 						dedup_segments += [s3]
-						used.append(s1)
-						used.append(s2)
+						used.add(s1.key())
+						used.add(s2.key())
 						break
 
-				if s1 not in used:
+				if s1.key() not in used:
 					dedup_segments += [s1]
 
 			segments = dedup_segments
@@ -195,3 +199,153 @@ class Segment:
 			return a
 		result = a + np.dot(ap, ab) / np.dot(ab, ab) * ab
 		return (round(result[0]), round(result[1]))
+
+
+# Segments as rows of one N×4 array (x0, y0, x1, y1, i.e. Segment.a and Segment.b), with vectorized operations
+# giving the same results as Segment methods on each segment
+class SegmentSet:
+
+	def __init__(self, array = None):
+		self.array = np.zeros((0, 4), dtype = int) if array is None else np.asarray(array, dtype = int).reshape(-1, 4)
+
+	@staticmethod
+	def from_segments(segments):
+		return SegmentSet([[*s.a, *s.b] for s in segments])
+
+	def __len__(self):
+		return len(self.array)
+
+	def __iter__(self):
+		for x0, y0, x1, y1 in self.array.tolist():
+			yield Segment((x0, y0), (x1, y1))
+
+	# a Segment for an index, a SegmentSet for a mask or a list of indexes
+	def __getitem__(self, key):
+		if isinstance(key, (int, np.integer)):
+			x0, y0, x1, y1 = self.array[key].tolist()
+			return Segment((x0, y0), (x1, y1))
+		return SegmentSet(self.array[key])
+
+	def dist_x(self):
+		return np.abs(self.array[:, 2] - self.array[:, 0])
+
+	def dist_y(self):
+		return np.abs(self.array[:, 3] - self.array[:, 1])
+
+	def dists(self):
+		return np.sqrt((self.dist_x()**2 + self.dist_y()**2).astype(float))
+
+	# in radians, in [0, pi/2] like Segment.angle()
+	def angles(self):
+		dist_x = self.dist_x()
+		with np.errstate(divide = 'ignore'):
+			return np.where(dist_x != 0, np.arctan(self.dist_y() / np.maximum(dist_x, 1)), math.pi / 2)
+
+	def to_xyrb(self):
+		return np.stack(
+			[
+				np.minimum(self.array[:, 0], self.array[:, 2]),
+				np.minimum(self.array[:, 1], self.array[:, 3]),
+				np.maximum(self.array[:, 0], self.array[:, 2]),
+				np.maximum(self.array[:, 1], self.array[:, 3]),
+			],
+			axis = 1
+		)
+
+	# Projection of each segment's a and b dots on the line of segment, see Segment.projected_point()
+	def projected_dots(self, segment):
+		a = np.array(segment.a)
+		ab = np.array(segment.b) - a
+		dots = self.array.reshape(-1, 2, 2)
+		if ab[0] == 0 and ab[1] == 0:
+			return np.broadcast_to(a, dots.shape)
+
+		ratios = ((dots - a) * ab).sum(axis = 2) / np.dot(ab, ab)
+		return np.rint(a + ratios[:, :, np.newaxis] * ab).astype(int)
+
+	# Mask of segments that intersect segment, see Segment.intersect()
+	def intersect_mask(self, segment):
+		if len(self) == 0:
+			return np.zeros(0, dtype = bool)
+
+		gutter = np.maximum(segment.dist(), self.dists()) * 5 / 100
+		left, top, right, bottom = self.to_xyrb().T
+
+		outside_x = (segment.right() < left - gutter) | (segment.left() > right + gutter)
+		outside_y = (segment.bottom() < top - gutter) | (segment.top() > bottom + gutter)
+		mask = ~(outside_x | outside_y)
+
+		# segments should be close to segment's line
+		projected = self.projected_dots(segment)
+		dists_to_line = np.sqrt(((projected - self.array.reshape(-1, 2, 2))**2).sum(axis = 2).astype(float))
+		mask &= ~((dists_to_line[:, 0] + dists_to_line[:, 1]) / 2 > gutter)
+
+		# angles may differ by a rounding error from Segment.angle()'s, check remaining segments the same way
+		angles = np.degrees(np.abs(self.angles() - segment.angle()))
+		mask &= angles < 10 + 1e-6
+		for i in np.flatnonzero(mask):
+			mask[i] = segment.angle_ok_with(self[i])
+
+		return mask
+
+	# Intersections of segment with these segments, unioned, see Segment.intersect_all()
+	def intersect_all(self, segment):
+		segments_match = []
+		for other in self[self.intersect_mask(segment)]:
+			sorted_dots = sorted([segment.a, segment.b, other.a, other.b], key = sum)
+			segments_match.append(Segment(*sorted_dots[1:3]))
+
+		return Segment.union_all(segments_match)
+
+	# Mask of segments that overlap panel, see Panel.contains_segment()
+	def overlap_mask(self, panel):
+		return panel.overlap_mask(self.to_xyrb())
+
+
+# Index of segments by angle and position, to find segments that may intersect (see Segment.intersect) each other:
+# their angles are less than 10 degrees apart, and their bounding boxes, grown by 5% of their length, overlap
+class SegmentIndex:
+
+	ANGLE_BUCKET = 10  # degrees, maximum angle between segments that may intersect
+
+	def __init__(self, segments):
+		self.segments = segments
+		self.buckets = {}  # (angle bucket, cell x, cell y) -> indexes of segments in there, in segments order
+
+		if not segments:
+			return
+
+		self.cell_size = max(16, 2 * sum(s.dist() for s in segments) / len(segments))
+
+		self.angle_buckets = []
+		self.cells = []
+		for i, s in enumerate(segments):
+			angle_bucket = int(math.degrees(s.angle()) // SegmentIndex.ANGLE_BUCKET)
+			cells = self.cells_of(s)
+
+			self.angle_buckets.append(angle_bucket)
+			self.cells.append(cells)
+			for cell in cells:
+				self.buckets.setdefault((angle_bucket, *cell), []).append(i)
+
+	# Grid cells covered by the segment's bounding box grown by its own gutter
+	def cells_of(self, s):
+		gutter = s.dist() * 5 / 100
+		x_min = math.floor((s.left() - gutter) / self.cell_size)
+		x_max = math.floor((s.right() + gutter) / self.cell_size)
+		y_min = math.floor((s.top() - gutter) / self.cell_size)
+		y_max = math.floor((s.bottom() + gutter) / self.cell_size)
+
+		return [(x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)]
+
+	# Indexes (after i, in increasing order) of segments that may intersect segment i
+	def candidates(self, i):
+		candidates = set()
+		angle_bucket = self.angle_buckets[i]
+		for cell in self.cells[i]:
+			for neighbour_bucket in [angle_bucket - 1, angle_bucket, angle_bucket + 1]:
+				for j in self.buckets.get((neighbour_bucket, *cell), []):
+					if j > i:
+						candidates.add(j)
+
+		return sorted(candidates)
@@ -2,6 +2,7 @@
 
 import os
 import json
+import argparse
 from bottle import route, run, request, static_file, abort
 from kumikolib import Kumiko
 from lib.html import HTML
@@ -20,7 +21,7 @@ def html():
 	if ext.lower() not in ('.png', '.jpg', '.jpeg'):
 		return "File extension not allowed."
 
-	k = Kumiko()
+	k = Kumiko({'cache_dir': args.cache_dir[0] if args.cache_dir else None})
 	k.parse_url_list([url])
 
 	infos = json.dumps(k.get_infos())
@@ -40,4 +41,12 @@ def static(filename):
 	return static_file(filename, root = './')
 
 
+parser = argparse.ArgumentParser(description = 'Kumiko server')
+parser.add_argument(
+	'--cache-dir',
+	nargs = 1,
+	help = 'A directory to keep page results in, pages already processed are not parsed again'
+)
+args = parser.parse_args()
+
 run(host = '127.0.0.1', port = 8091)
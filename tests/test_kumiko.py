@@ -3,6 +3,17 @@ import subprocess
 import json
 import re
 import os
+import functools
+import threading
+import zipfile
+import cv2 as cv
+import numpy as np
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from kumikolib import Kumiko
+from lib.page import Page
+from lib.debug import Debug
+from lib.panel import Panel, PanelArray
+from lib.segment import Segment, SegmentSet
 from tests.base import BaseTest
 
 
@@ -25,6 +36,288 @@ class TestKumiko(BaseTest):
 
 		self.assertPanelsEqual(panels, self.simple_image_panels)
 
+	def test_stdin_input(self):
+		with open(self.simple_image, 'rb') as fh:
+			res = subprocess.run(['./kumiko', '-i', '-'], input = fh.read(), capture_output = True)
+		out = json.loads(res.stdout)
+
+		self.assertEqual(out[0]['filename'], 'stdin')
+		self.assertPanelsEqual(out[0]['panels'], self.simple_image_panels)
+
+	def test_manifest(self):
+		manifest_file = os.path.join(BaseTest.results_dir(), 'manifest')
+		outputs = []
+		for _ in range(2):  # second run gets results from manifest
+			res = subprocess.run(
+				['./kumiko', '-i', self.simple_image, '--manifest', manifest_file, '--progress'],
+				capture_output = True
+			)
+			outputs.append(res)
+
+		self.assertNotIn('(unchanged)', outputs[0].stderr.decode("utf-8"))
+		self.assertIn('(unchanged)', outputs[1].stderr.decode("utf-8"))
+		for res in outputs:
+			self.assertPanelsEqual(json.loads(res.stdout)[0]['panels'], self.simple_image_panels)
+
+	def test_cbz_input(self):
+		cbz_file = os.path.join(BaseTest.results_dir(), 'book.cbz')
+		with zipfile.ZipFile(cbz_file, 'w') as zf:
+			zf.write(self.simple_image, 'page10.png')
+			zf.write(self.simple_image, 'page9.png')
+			zf.writestr('info.txt', 'not a page')
+
+		res = subprocess.run(['./kumiko', '-i', cbz_file], capture_output = True)
+		out = json.loads(res.stdout)
+
+		self.assertEqual([page['filename'] for page in out], ['page9.png', 'page10.png'])
+		for page in out:
+			self.assertPanelsEqual(page['panels'], self.simple_image_panels)
+
+	def test_cbz_same_file_names(self):
+		cbz_file = os.path.join(BaseTest.results_dir(), 'chapters.cbz')
+		with zipfile.ZipFile(cbz_file, 'w') as zf:
+			zf.write(self.simple_image, 'a/02.png')
+			zf.write(self.simple_image, 'b/02.png')
+
+		out_dir = BaseTest.results_dir()
+		res = subprocess.run(['./kumiko', '-i', cbz_file, '--save-panels', out_dir], capture_output = True)
+		out = json.loads(res.stdout)
+
+		self.assertEqual([page['filename'] for page in out], ['a/02.png', 'b/02.png'])
+		for member in ['a', 'b']:
+			panel_files = os.listdir(os.path.join(out_dir, member, '02.png'))
+			self.assertEqual(len(panel_files), len(self.simple_image_panels))
+
+	def test_parallel_jobs(self):
+		folder = './tests/images/003-panels-expand'
+		res_serial = subprocess.run(['./kumiko', '-i', folder], capture_output = True)
+		res_parallel = subprocess.run(['./kumiko', '-i', folder, '--jobs', '2'], capture_output = True)
+
+		out_serial = json.loads(res_serial.stdout)
+		out_parallel = json.loads(res_parallel.stdout)
+
+		self.assertEqual(len(out_serial), len(out_parallel))
+		for page_serial, page_parallel in zip(out_serial, out_parallel):
+			self.assertEqual(page_serial['filename'], page_parallel['filename'])
+			self.assertPanelsEqual(page_serial['panels'], page_parallel['panels'])
+
+	def test_pipeline_threads(self):
+		folder = './tests/images/005-panels-without-frame'
+		k_serial = Kumiko()
+		k_serial.parse_dir(folder)
+
+		k_pipeline = Kumiko({'threads': 3})
+		k_pipeline.parse_dir(folder)
+
+		self.assertEqual(len(k_serial.page_list), len(k_pipeline.page_list))
+		for page_serial, page_pipeline in zip(k_serial.get_infos(), k_pipeline.get_infos()):
+			self.assertEqual(page_serial['filename'], page_pipeline['filename'])
+			self.assertPanelsEqual(page_serial['panels'], page_pipeline['panels'])
+
+		stats = k_pipeline.pipeline.stats()
+		self.assertEqual([s['stage'] for s in stats], ['decode', 'opencv', 'geometry', 'output'])
+		for s in stats:
+			self.assertEqual(s['items'], len(Kumiko.list_dir(folder)))  # license files go through as well
+			self.assertLessEqual(s['queue_depth_max'], k_pipeline.pipeline.max_pending)
+
+	def test_ndjson_output(self):
+		folder = './tests/images/003-panels-expand'
+		res_json = subprocess.run(['./kumiko', '-i', folder], capture_output = True)
+		res_ndjson = subprocess.run(['./kumiko', '-i', folder, '--ndjson'], capture_output = True)
+
+		out_json = json.loads(res_json.stdout)
+		out_ndjson = list(map(json.loads, res_ndjson.stdout.decode("utf-8").splitlines()))
+
+		self.assertEqual(len(out_json), len(out_ndjson))
+		for page_json, page_ndjson in zip(out_json, out_ndjson):
+			self.assertEqual(page_json['filename'], page_ndjson['filename'])
+			self.assertPanelsEqual(page_json['panels'], page_ndjson['panels'])
+
+	def test_results_cache(self):
+		cache_dir = BaseTest.results_dir()
+		outputs = []
+		for _ in range(2):  # second run gets results from cache
+			res = subprocess.run(
+				['./kumiko', '-i', self.simple_image, '--cache-dir', cache_dir], capture_output = True
+			)
+			outputs.append(json.loads(res.stdout))
+
+		self.assertEqual(len(os.listdir(cache_dir)), 1)
+		for out in outputs:
+			self.assertEqual(out[0]['filename'], 'simple.png')
+			self.assertPanelsEqual(out[0]['panels'], self.simple_image_panels)
+
+	def test_url_list(self):
+		handler = functools.partial(SimpleHTTPRequestHandler, directory = os.path.dirname(self.simple_image))
+		server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+		threading.Thread(target = server.serve_forever, daemon = True).start()
+
+		base_url = f"http://127.0.0.1:{server.server_address[1]}/"
+		urls = [base_url + os.path.basename(self.simple_image), base_url + 'missing.png', base_url + 'simple.png']
+		try:
+			res = subprocess.run(['./kumiko', '-i', *urls, '--jobs', '2'], capture_output = True)
+		finally:
+			server.shutdown()
+			server.server_close()
+
+		out = json.loads(res.stdout)
+		self.assertEqual([page['filename'] for page in out], [urls[0], urls[2]])
+		for page in out:
+			self.assertPanelsEqual(page['panels'], self.simple_image_panels)
+
+	def test_lightweight_pages(self):
+		k = Kumiko()
+		k.parse_image(self.simple_image)
+		page = k.page_list[0]
+
+		self.assertIsNone(page.gray)
+		self.assertIsNone(page.panels[0].polygon)
+		self.assertPanelsEqual(k.get_infos()[0]['panels'], self.simple_image_panels)
+		self.assertEqual(list(page.img.shape[:2]), [1200, 848])  # decoded again when needed
+
+		cbz_file = os.path.join(BaseTest.results_dir(), 'lightweight.cbz')
+		with zipfile.ZipFile(cbz_file, 'w') as zf:
+			zf.write(self.simple_image, 'page1.png')
+
+		with open(self.simple_image, 'rb') as fh:
+			image = fh.read()
+		pages = list(k.iter_archive_pages(cbz_file)) + list(k.iter_image_data_pages(image))
+
+		self.assertIsNone(pages[0].image.data)  # archive page is read again when needed
+		self.assertEqual(list(pages[0].img.shape[:2]), [1200, 848])
+		self.assertIsNone(pages[1].image)  # image data given directly isn't kept once consumed
+
+	def test_gray_decoding(self):
+		k = Kumiko({'lightweight': False})
+		k.parse_image(self.simple_image)
+		page = k.page_list[0]
+
+		self.assertIsNone(page._img)  # colour image not decoded for panels detection
+		self.assertEqual(page.gray.shape, (1200, 848))
+		self.assertEqual(page.img.shape, (1200, 848, 3))
+
+		k = Kumiko({'max_pixels': 848 * 1200 // 4})
+		k.parse_image(self.simple_image)  # decoded at half size
+		self.assertPanelsEqual(k.get_infos()[0]['panels'], self.simple_image_panels)
+
+	def test_segments_union(self):
+		segments = [
+			Segment((0, 100), (200, 100)),
+			Segment((500, 0), (500, 300)),  # perpendicular, far away
+			Segment((190, 101), (400, 101)),
+			Segment((395, 100), (600, 102)),
+			Segment((0, 500), (600, 500)),  # parallel, far away
+		]
+		unioned = [(s.a, s.b) for s in Segment.union_all(segments)]
+
+		self.assertEqual(len(unioned), 3)
+		self.assertIn(((0, 100), (600, 102)), unioned)
+
+	def test_segment_set(self):
+		segments = [
+			Segment((0, 100), (200, 101)),
+			Segment((500, 0), (500, 300)),
+			Segment((300, 98), (600, 102)),
+		]
+		segment_set = SegmentSet.from_segments(segments)
+		split = Segment((0, 100), (600, 100))
+
+		self.assertEqual(list(segment_set.intersect_mask(split)), [split.intersect(s) is not None for s in segments])
+		self.assertEqual(segment_set.dists().tolist(), [s.dist() for s in segments])
+		self.assertEqual([(s.a, s.b) for s in segment_set[1:]], [(s.a, s.b) for s in segments[1:]])
+
+	def test_numbering_without_expansion(self):
+		res = subprocess.run(['./kumiko', '-i', self.simple_image, '--no-panel-expansion'], capture_output = True)
+		out = json.loads(res.stdout)
+
+		self.assertPanelsEqual(out[0]['panels'], self.simple_image_panels)  # in reading order
+
+	def test_panels_index(self):
+		k = Kumiko({'lightweight': False})
+		k.parse_dir('./tests/images/003-panels-expand')
+		page = k.page_list[0]
+
+		queries = ['find_top_panel', 'find_bottom_panel', 'find_left_panel', 'find_right_panel']
+		queries += ['find_all_left_panels', 'find_all_right_panels']
+		results = [[getattr(p, q)() for q in queries] for p in page.panels]
+		with page.indexed_panels():
+			indexed_results = [[getattr(p, q)() for q in queries] for p in page.panels]
+
+		self.assertEqual(str(results), str(indexed_results))  # same panel objects
+		self.assertIsNone(page.panels_index)
+
+	def test_panel_array(self):
+		k = Kumiko({'lightweight': False})
+		k.parse_dir('./tests/images/003-panels-expand')
+		page = k.page_list[0]
+		panels = page.panels + [Panel.from_xyrb(page, 0, 0, 300, 300)]  # overlapping some panels
+		panel_array = PanelArray.from_panels(page, panels)
+
+		for method in ['overlaps', 'contains', 'same_row', 'same_col']:
+			expected = [[getattr(p1, method)(p2) for p2 in panels] for p1 in panels]
+			self.assertEqual(getattr(panel_array, method)().tolist(), expected)
+		self.assertEqual(panel_array.equals().tolist(), [[p1 == p2 for p2 in panels] for p1 in panels])
+		self.assertEqual(panel_array.is_small(2).tolist(), [p.is_small(2) for p in panels])
+
+		others = panels[-2:]
+		expected = [[p1.contains(p2) for p2 in others] for p1 in panels]
+		self.assertEqual(panel_array.contains(PanelArray.from_panels(page, others)).tolist(), expected)
+
+	def test_split_equal_panels(self):
+		# two framed panels joined by a line across the gutter make one contour, split in two
+		img = np.full((1000, 800, 3), 255, np.uint8)
+		cv.rectangle(img, (50, 50), (750, 480), (0, 0, 0), 3)
+		cv.rectangle(img, (50, 520), (750, 950), (0, 0, 0), 3)
+		cv.line(img, (300, 400), (320, 600), (0, 0, 0), 3)
+
+		page = Page('joined.png', numbering = 'ltr', image = img, parse = False)
+		page.decode()
+		page.detect_features()
+		page.get_initial_panels()
+		page.group_small_panels()
+
+		# a panel equal to the contour's one (see Panel.__eq__()) but another object, listed first
+		p = page.panels[0]
+		q = Panel.from_xyrb(page, p.x + 1, p.y, p.r, p.b)
+		q.polygon = p.polygon
+		page.panels = [q, p]
+
+		page.split_panels()
+
+		self.assertEqual(len(page.panels), 4)  # both split
+		self.assertFalse(any(panel is p or panel is q for panel in page.panels))
+
+	def test_max_pixels(self):
+		k = Kumiko({'max_pixels': 300000, 'snap_edges': True})
+		k.parse_image(self.simple_image)
+
+		self.assertPanelsEqual(k.get_infos()[0]['panels'], self.simple_image_panels)
+		self.assertEqual(k.get_infos()[0]['size'], [848, 1200])  # full size coordinates
+
+	def test_max_pixels_debug_steps(self):
+
+		def infos(filename, size, panels, gutter = 2):
+			return {'filename': filename, 'size': size, 'gutters': [gutter, gutter], 'panels': panels}
+
+		steps = [
+			infos('page.png', [848, 1200], []),  # initial state, at full size
+			infos('page.png', [424, 600], [[18, 28, 134, 124], [168, 28, 234, 124]]),
+			infos('other.png', [424, 600], [[18, 28, 134, 124]]),
+		]
+		saved = Debug.debug, Debug.steps
+		try:
+			Debug.debug = True
+			Debug.steps = [{'name': str(i), 'infos': step} for i, step in enumerate(steps)]
+			Debug.upscale_steps('page.png', [424, 600], [848, 1200])
+		finally:
+			Debug.debug, Debug.steps = saved
+
+		self.assertEqual(steps[0], infos('page.png', [848, 1200], []))
+		self.assertEqual(
+			steps[1], infos('page.png', [848, 1200], [[36, 56, 268, 248], [336, 56, 468, 248]], gutter = 4)
+		)
+		self.assertEqual(steps[2], infos('other.png', [424, 600], [[18, 28, 134, 124]]))  # another page
+
 	def test_panels_saving(self):
 		res = subprocess.run(
 			['./kumiko', '-i', self.simple_image, '--save-panels',
@@ -40,6 +333,23 @@ class TestKumiko(BaseTest):
 		out_dir = os.path.join(match[1], 'simple.png')
 		self.assertEqual(len(os.listdir(out_dir)), len(self.simple_image_panels))
 
+	def test_panels_saving_format(self):
+		out_dir = BaseTest.results_dir()
+		subprocess.run(
+			[
+				'./kumiko', '-i', self.simple_image, '--save-panels', out_dir, '--panels-format', 'png',
+				'--panels-max-size', '100'
+			],
+			capture_output = True
+		)
+
+		out_dir = os.path.join(out_dir, 'simple.png')
+		self.assertEqual(sorted(os.listdir(out_dir)), [f"panel_{i}.png" for i in range(len(self.simple_image_panels))])
+
+		for filename in os.listdir(out_dir):
+			img = cv.imread(os.path.join(out_dir, filename))
+			self.assertLessEqual(max(img.shape[:2]), 100)
+
 
 if __name__ == '__main__':
 	BaseTest.run_all()